@@ -18,5 +18,30 @@ app = Celery("athene")
 #   should have a `CELERY_` prefix.
 app.config_from_object("django.conf:settings", namespace="CELERY")
 
+# Tasks are split across queues so that big sends and syncs can't hold up forwarding replies; each queue has
+# its own worker in the Procfile. Anything not listed here goes to the interactive queue.
+app.conf.task_default_queue = "interactive"
+app.conf.task_routes = {
+    "seekers.tasks.async_request": {"queue": "interactive"},
+    "seekers.tasks.flush_forwarded_messages": {"queue": "interactive"},
+    "seekers.tasks.apply_mailchimp_update": {"queue": "interactive"},
+    "seekers.tasks.queue_campaign": {"queue": "bulk"},
+    "seekers.tasks.send_message": {"queue": "bulk"},
+    "seekers.tasks.send_messages_bulk": {"queue": "bulk"},
+    "seekers.tasks.send_email_batch": {"queue": "bulk"},
+    "seekers.tasks.flush_message_statuses": {"queue": "sync"},
+    "seekers.tasks.refresh_mailchimp_member": {"queue": "sync"},
+    "seekers.tasks.refresh_mailchimp_members": {"queue": "sync"},
+    "seekers.tasks.sync_mailchimp_list": {"queue": "sync"},
+    "seekers.tasks.poll_mailchimp_batches": {"queue": "sync"},
+    "seekers.tasks.flush_mailchimp_events": {"queue": "sync"},
+    "events.tasks.dispatch_autotext": {"queue": "sync"},
+    "events.tasks.fetch_autotext_events": {"queue": "sync"},
+    "events.tasks.send_autotext_digests": {"queue": "sync"},
+    "events.tasks.sync_calendar": {"queue": "sync"},
+    "events.tasks.sync_calendars": {"queue": "sync"},
+    "events.tasks.renew_calendar_watches": {"queue": "sync"},
+}
+
 # Load task modules from all registered Django app configs.
 app.autodiscover_tasks()
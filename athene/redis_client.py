@@ -0,0 +1,181 @@
+import json
+import logging
+import time
+
+from django.conf import settings
+import redis
+
+logger = logging.getLogger(__name__)
+
+client = redis.Redis.from_url(settings.REDIS_URL)
+
+
+class TokenBucket(object):
+    """A rate limiter shared by every process using the same Redis. Tokens refill at ``rate`` per second, up
+    to ``capacity``."""
+
+    # Takes a token if there is one, and returns how long to wait for the next one otherwise
+    SCRIPT = """
+        local rate = tonumber(ARGV[1])
+        local capacity = tonumber(ARGV[2])
+        local now = tonumber(ARGV[3])
+        local state = redis.call("HMGET", KEYS[1], "tokens", "timestamp")
+        local tokens = tonumber(state[1]) or capacity
+        local timestamp = tonumber(state[2]) or now
+        tokens = math.min(capacity, tokens + math.max(0, now - timestamp) * rate)
+        local wait = 0
+        if tokens >= 1 then
+            tokens = tokens - 1
+        else
+            wait = (1 - tokens) / rate
+        end
+        redis.call("HMSET", KEYS[1], "tokens", tokens, "timestamp", now)
+        redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) + 1)
+        return tostring(wait)
+    """
+
+    def __init__(self, key, rate, capacity=1):
+        self.key = f"ratelimit:{key}"
+        self.rate = rate
+        self.capacity = capacity
+        self.script = client.register_script(self.SCRIPT)
+
+    def acquire(self):
+        """Blocks until a token is available. If Redis can't be reached, this doesn't wait at all."""
+        while True:
+            try:
+                wait = float(self.script(keys=[self.key], args=[self.rate, self.capacity, time.time()]))
+            except redis.RedisError:
+                logger.exception(f"Could not reach Redis for rate limit {self.key}")
+                return
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+class CircuitBreaker(object):
+    """Trips after ``threshold`` failures within ``window`` seconds, and stays open for ``cooldown`` seconds,
+    so that callers can give up on an unhealthy service straight away. Shared by every process using the
+    same Redis."""
+
+    def __init__(self, name, threshold=5, window=60, cooldown=120):
+        self.name = name
+        self.failures_key = f"circuit:{name}:failures"
+        self.open_key = f"circuit:{name}:open"
+        self.threshold = threshold
+        self.window = window
+        self.cooldown = cooldown
+
+    def is_open(self):
+        try:
+            return bool(client.exists(self.open_key))
+        except redis.RedisError:
+            logger.exception(f"Could not reach Redis for circuit breaker {self.name}")
+            return False
+
+    def record_failure(self):
+        try:
+            pipeline = client.pipeline()
+            pipeline.incr(self.failures_key)
+            pipeline.expire(self.failures_key, self.window)
+            failures, _ = pipeline.execute()
+            if failures >= self.threshold:
+                logger.warning(f"Too many failures for {self.name}, holding off for {self.cooldown} seconds")
+                client.set(self.open_key, 1, ex=self.cooldown)
+                client.delete(self.failures_key)
+        except redis.RedisError:
+            logger.exception(f"Could not reach Redis for circuit breaker {self.name}")
+
+    def record_success(self):
+        try:
+            client.delete(self.failures_key)
+        except redis.RedisError:
+            logger.exception(f"Could not reach Redis for circuit breaker {self.name}")
+
+
+class Debouncer(object):
+    """Collects values in Redis so that a task can handle everything added within ``delay`` seconds of the first
+    in one run. Values are appended to a list, or with ``merge``, are dicts whose fields are merged into a hash,
+    later values winning. With ``leading``, the first value in each window is handled straight away instead, and
+    only those after it are held back, until the window closes. Shared by every process using the same Redis."""
+
+    # With ``leading``, handles a value straight away (-1) if it opens a window and nothing is held back, so that
+    # values are always handled in order. Otherwise holds it back, returning the milliseconds until the window
+    # closes if the task needs scheduling, or -2 if it's already scheduled.
+    LEADING_SCRIPT = """
+        if redis.call("EXISTS", KEYS[1]) == 0 and redis.call("SET", KEYS[2], 1, "NX", "EX", ARGV[1]) then
+            return -1
+        end
+        redis.call("RPUSH", KEYS[1], ARGV[2])
+        if redis.call("SET", KEYS[3], 1, "NX", "EX", ARGV[1] * 2) then
+            return math.max(redis.call("PTTL", KEYS[2]), 0)
+        end
+        return -2
+    """
+
+    def __init__(self, key, delay, merge=False, leading=False, expiry=None):
+        self.key = key
+        self.scheduled_key = f"{key}:scheduled"
+        self.window_key = f"{key}:window"
+        self.delay = delay
+        self.merge = merge
+        self.leading = leading
+        self.expiry = expiry
+        self.leading_script = client.register_script(self.LEADING_SCRIPT)
+
+    def add(self, value, schedule, handle_now):
+        """Holds ``value`` back, calling ``schedule`` with the delay if the task needs scheduling for it. If it
+        should be handled straight away, or Redis can't be reached, ``handle_now`` is called instead."""
+        try:
+            if self.leading:
+                result = self.leading_script(
+                    keys=[self.key, self.window_key, self.scheduled_key], args=[self.delay, json.dumps(value)]
+                )
+                if result == -1:
+                    handle_now()
+                elif result >= 0:
+                    # The held values go out once the window closes
+                    schedule(result / 1000)
+                return
+            pipeline = client.pipeline()
+            if self.merge:
+                pipeline.hset(self.key, mapping={field: json.dumps(item) for field, item in value.items()})
+            else:
+                pipeline.rpush(self.key, json.dumps(value))
+            if self.expiry:
+                pipeline.expire(self.key, self.expiry)
+            # The first value held back since the last run schedules the next one
+            pipeline.set(self.scheduled_key, 1, nx=True, ex=self.delay * 2)
+            *_, first = pipeline.execute()
+        except redis.RedisError:
+            logger.exception(f"Could not reach Redis, handling {self.key} straight away")
+            handle_now()
+            return
+        if first:
+            schedule(self.delay)
+
+    def restore(self, value):
+        """Puts back fields of a merged value that couldn't be handled, without overwriting any added since. Returns
+        whether the task needs scheduling for them, because no run is already due."""
+        pipeline = client.pipeline()
+        for field, item in value.items():
+            pipeline.hsetnx(self.key, field, json.dumps(item))
+        if self.expiry:
+            pipeline.expire(self.key, self.expiry)
+        pipeline.set(self.scheduled_key, 1, nx=True, ex=self.delay * 2)
+        *_, first = pipeline.execute()
+        return bool(first)
+
+    def drain(self):
+        """Returns the values held back, and clears them. Values added from now on schedule another run."""
+        client.delete(self.scheduled_key)
+        pipeline = client.pipeline()
+        if self.merge:
+            pipeline.hgetall(self.key)
+        else:
+            pipeline.lrange(self.key, 0, -1)
+        pipeline.delete(self.key)
+        values, _ = pipeline.execute()
+        if self.merge:
+            return {field.decode(): json.loads(item) for field, item in values.items()}
+        return [json.loads(item) for item in values]
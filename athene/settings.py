@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 import os
 import json
 
+from celery.schedules import crontab
 import dj_database_url
 
 
@@ -173,6 +174,8 @@ CKEDITOR_CONFIGS = {
 
 GOOGLEMAPS_API = os.environ.get("GOOGLEMAPS_API", None)
 
+GOOGLE_CALENDAR_WEBHOOK_URL = os.environ.get("GOOGLE_CALENDAR_WEBHOOK_URL")
+
 MAILCHIMP_API_KEY = os.environ.get("MAILCHIMP_API_KEY")
 MAILCHIMP_USERNAME = os.environ.get("MAILCHIMP_USERNAME")
 MAILCHIMP_LIST_ID = os.environ.get("MAILCHIMP_LIST_ID")
@@ -202,8 +205,33 @@ DEFAULT_FROM_EMAIL = "athene@seekers.seekhealing.org"
 MAILGUN_BYPASS_SIGNATURE = os.environ.get("MAILGUN_BYPASS_SIGNATURE")
 
 TWILIO_BYPASS_SIGNATURE = os.environ.get("TWILIO_BYPASS_SIGNATURE")
-
-CELERY_BROKER_URL = os.environ.get("REDIS_URL", "redis://127.0.0.1:6379/1")
-CELERY_RESULT_BACKEND = os.environ.get("REDIS_URL", "redis://127.0.0.1:6379/1")
+# Point this at a local stand-in (see the faketwilio command) to send texts from a development environment
+TWILIO_API_BASE = os.environ.get("TWILIO_API_BASE")
+# Messages per second allowed across every worker, and how many can go out at once after a quiet spell
+TWILIO_RATE_LIMIT = float(os.environ.get("TWILIO_RATE_LIMIT", "1"))
+TWILIO_RATE_BURST = int(os.environ.get("TWILIO_RATE_BURST", "5"))
+# Where Twilio reports delivery of the texts we send, e.g. https://athene.example.org/webhooks/twilio/status/
+TWILIO_STATUS_CALLBACK_URL = os.environ.get("TWILIO_STATUS_CALLBACK_URL")
+
+REDIS_URL = os.environ.get("REDIS_URL", "redis://127.0.0.1:6379/1")
+
+CELERY_BROKER_URL = REDIS_URL
+CELERY_RESULT_BACKEND = REDIS_URL
+CELERY_TIMEZONE = TIME_ZONE
+CELERY_BEAT_SCHEDULE = {
+    "sync-calendars": {"task": "events.tasks.sync_calendars", "schedule": 60.0 * 5},
+    "renew-calendar-watches": {"task": "events.tasks.renew_calendar_watches", "schedule": 60.0 * 60},
+    "flush-message-statuses": {"task": "seekers.tasks.flush_message_statuses", "schedule": 30.0},
+    "sync-mailchimp-list": {"task": "seekers.tasks.sync_mailchimp_list", "schedule": 60.0 * 15},
+    "refresh-mailchimp-members": {"task": "seekers.tasks.refresh_mailchimp_members", "schedule": 60.0 * 60},
+    "poll-mailchimp-batches": {"task": "seekers.tasks.poll_mailchimp_batches", "schedule": 60.0},
+    "dispatch-autotext": {
+        "task": "events.tasks.dispatch_autotext",
+        "schedule": crontab(hour=int(os.environ.get("AUTOTEXT_HOUR", "9")), minute=0),
+    },
+}
 
 DEFAULT_SLACK_CHANNEL = "#techstuff" if DEBUG else "#general"
+# Replies forwarded to a channel within this many seconds of the first are posted together after it; 0 posts
+# each one as it comes
+SLACK_COALESCE_SECONDS = int(os.environ.get("SLACK_COALESCE_SECONDS", "60"))
@@ -19,6 +19,7 @@ from django.http import HttpResponse, HttpResponseRedirect
 from django.urls import path, re_path, include
 
 from seekers import views
+from events import views as events_views
 
 robots_txt = HttpResponse("User-agent: *\nDisallow: /", content_type="text/plain")
 robots_txt["Cache-Control"] = "max-age=1209600"
@@ -29,7 +30,11 @@ urlpatterns = [
     path("admin/", admin.site.urls),
     re_path("^robots.txt$", lambda r: robots_txt),
     path("webhooks/mailgun/", views.mailgun_webhook),
+    path("webhooks/mailgun/events/", views.mailgun_events_webhook),
     path("webhooks/twilio/", views.twilio_webhook),
+    path("webhooks/twilio/status/", views.twilio_status_webhook),
+    path("webhooks/mailchimp/", views.mailchimp_webhook),
+    path("webhooks/google-calendar/", events_views.google_calendar_webhook),
     path("", lambda r: index),
 ]
 
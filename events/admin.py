@@ -1,18 +1,24 @@
 import datetime
+import json
 
 from dateutil import parser
 from django.conf import settings
 from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList
 from django.contrib.admin.widgets import AdminDateWidget
+from django.http import HttpResponseRedirect
+from django.urls import reverse
 from django.utils.timezone import localdate
 from django.template.response import TemplateResponse
 from django import forms
 from pytz import timezone
 
 from . import models
+from . import google
 from .google import calendar as client
 from seekers.forms import MassTextForm
-from seekers import tasks, constants
+from seekers.models import Campaign
+from seekers import tasks
 
 
 class HumanCalendarSubscriptionAdmin(admin.TabularInline):
@@ -25,19 +31,21 @@ def mass_text(modeladmin, request, queryset):
     if request.POST.get("submitted"):
         form_obj = MassTextForm(request.POST)
         if form_obj.is_valid():
-            recipients = (
-                models.HumanCalendarSubscription.objects.filter(calendar__in=queryset.values_list("pk", flat=True))
-                .values_list("human", "contact_method")
-                .distinct()
+            campaign_obj = Campaign.objects.create(
+                source=Campaign.CALENDARS,
+                selected_ids=json.dumps(list(queryset.values_list("pk", flat=True))),
+                email_subject=form_obj.cleaned_data.get("email_subject"),
+                email_body=form_obj.cleaned_data.get("email_body"),
+                sms_body=form_obj.cleaned_data.get("sms_body"),
+                created_by=request.user,
             )
-            for human_id, contact_method in recipients:
-                tasks.send_message.delay(
-                    human_id,
-                    contact_method,
-                    form_obj.cleaned_data.get("sms_body" if contact_method == constants.SMS else "email_body"),
-                    form_obj.cleaned_data.get("email_subject"),
-                )
-            modeladmin.message_user(request, f"Sending email/SMS to {len(recipients)} human(s).", messages.SUCCESS)
+            tasks.queue_campaign.delay(campaign_obj.pk)
+            modeladmin.message_user(
+                request, f"Sending email/SMS to subscribers of {len(queryset)} calendar(s).", messages.SUCCESS
+            )
+            # Follow the campaign's progress, for those allowed to see it, or go back to the list otherwise
+            if request.user.has_perm("seekers.view_campaign"):
+                return HttpResponseRedirect(reverse("admin:seekers_campaign_change", args=[campaign_obj.pk]))
             return None
     else:
         form_obj = MassTextForm()
@@ -60,14 +68,24 @@ class CalendarAdmin(admin.ModelAdmin):
 
 
 class CheckinModelForm(forms.ModelForm):
+    # The event being checked in to, if the admin has already looked it up
+    prefetched_event = None
+
     def clean(self):
         cleaned_data = super().clean()
+        calendar_obj, event_id = cleaned_data.get("calendar"), cleaned_data.get("event_id")
+        if not (calendar_obj and event_id):
+            return cleaned_data
         try:
-            event = client.get_event(cleaned_data["calendar_id"], cleaned_data["event_id"])
-            if event.get("recurringEventId"):
-                assert event.get("recurringEventid") == cleaned_data["recurring_event_id"]
+            if self.prefetched_event and self.prefetched_event.get("id") == event_id:
+                self.event = self.prefetched_event
+            else:
+                self.event = client.get_event(calendar_obj.calendar_id, event_id)
+            if self.event.get("recurringEventId"):
+                assert self.event["recurringEventId"] == cleaned_data["recurring_event_id"]
         except (AssertionError, ValueError):
             raise forms.ValidationError("The event identifier given is invalid.")
+        return cleaned_data
 
     class Meta:
         model = models.HumanAttendance
@@ -78,14 +96,37 @@ class DatePickerForm(forms.Form):
     event_date = forms.DateField(widget=AdminDateWidget())
 
 
+class HumanAttendanceChangeList(ChangeList):
+    def get_results(self, request):
+        super().get_results(request)
+        self.result_list = models.HumanAttendance.resolve_events(self.result_list)
+
+
 class HumanAttendanceAdmin(admin.ModelAdmin):
     model = models.HumanAttendance
+    form = CheckinModelForm
     autocomplete_fields = ["human"]
     hidden_fields = ["calendar", "event_id", "recurring_event_id"]
+    list_display = ["human", "event_name", "event_start", "created"]
+    list_select_related = ["human"]
+
+    def get_changelist(self, request, **kwargs):
+        return HumanAttendanceChangeList
 
     def has_change_permission(self, request, obj=None):
         return False
 
+    def get_form(self, request, obj=None, **kwargs):
+        form_class = super().get_form(request, obj, **kwargs)
+        form_class.prefetched_event = getattr(request, "checkin_event", None)
+        return form_class
+
+    def save_model(self, request, obj, form, change):
+        # Snapshot the event the form checked, rather than looking it up again
+        if not obj.event_summary and getattr(form, "event", None):
+            obj.apply_event(form.event)
+        super().save_model(request, obj, form, change)
+
     def formfield_for_dbfield(self, db_field, request, **kwargs):
         if db_field.name in self.hidden_fields:
             return db_field.formfield(widget=forms.HiddenInput(), **kwargs)
@@ -119,12 +160,12 @@ class HumanAttendanceAdmin(admin.ModelAdmin):
         if "calendar" in request.GET and "event_id" in request.GET:
             # We're doing check-ins for the event
             calendar_id, event_id = request.GET["calendar"], request.GET["event_id"]
-            event = client.get_event(calendar_id, event_id)
+            event = request.checkin_event = client.get_event(calendar_id, event_id)
             extra_context.update(
                 dict(
-                    already_checked_in=self.model.objects.filter(calendar_id=calendar_id, event_id=event_id).order_by(
-                        "-created"
-                    ),
+                    already_checked_in=self.model.objects.filter(calendar_id=calendar_id, event_id=event_id)
+                    .select_related("human")
+                    .order_by("-created"),
                     event=self.process_event(models.Calendar.objects.get(calendar_id=calendar_id), event),
                     stage="checkin",
                     title=f'Check in for {event["summary"]}',
@@ -146,15 +187,17 @@ class HumanAttendanceAdmin(admin.ModelAdmin):
             else:
                 date = localdate()
 
-            calendar_objs = models.Calendar.objects.filter(inactive_date__isnull=True, track_attendance=True)
-            events = []
+            calendar_objs = {
+                calendar_obj.calendar_id: calendar_obj
+                for calendar_obj in models.Calendar.objects.filter(inactive_date__isnull=True, track_attendance=True)
+            }
             local_tz = timezone(settings.TIME_ZONE)
             start_dt = local_tz.localize(datetime.datetime.combine(date, datetime.time(0)))
             end_dt = start_dt + datetime.timedelta(days=1)
-            for calendar_obj in calendar_objs:
-                for event in client.get_upcoming_events(calendar_obj.calendar_id, start_dt=start_dt, end_dt=end_dt):
-                    events.append(self.process_event(calendar_obj, event))
-            events.sort(key=lambda event: event["start_dt"])
+            events = [
+                self.process_event(calendar_objs[calendar_id], event)
+                for calendar_id, event in google.fetch_upcoming_events(calendar_objs.keys(), start_dt, end_dt)
+            ]
             extra_context.update(
                 dict(
                     upcoming_events=events,
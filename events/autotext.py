@@ -0,0 +1,217 @@
+from collections import defaultdict
+import datetime
+import logging
+import re
+
+from celery import group
+from dateutil.parser import parse
+from django.db import transaction
+from django.template import Context, Template, loader
+from django.utils.timezone import localdate, now
+import pytz
+
+from seekers import constants, tasks
+from . import models, google
+
+logger = logging.getLogger(__name__)
+
+
+class AlreadySent(Exception):
+    pass
+
+
+# How many messages are queued together at a time
+SEND_CHUNK_SIZE = 100
+
+
+def normalize_event(event):
+    begin = parse(event["start"]["dateTime"]).astimezone(pytz.timezone("US/Eastern"))
+    end = parse(event["end"]["dateTime"]).astimezone(pytz.timezone("US/Eastern"))
+    description = re.sub(r"\n+", "\n", event["description"].replace("<br>", "\n").replace("&nbsp;", " "))
+    zoom_link = re.search(r"https://zoom\.us/j/[0-9]{10}", description)
+    if zoom_link:
+        hangout_link = zoom_link.group(0)
+    else:
+        hangout_link = event.get("hangoutLink", "")
+    return dict(
+        name=event["summary"],
+        begin=begin,
+        end=end,
+        description=description,
+        location=event.get("location"),
+        hangoutLink=hangout_link,
+    )
+
+
+def due_calendars(include_all=False):
+    """Returns the calendars whose autotext goes out today. With ``include_all``, calendars that only
+    send on other days are included too."""
+    calendar_objs = []
+    for calendar_obj in models.Calendar.objects.filter(inactive_date__isnull=True):
+        if not (calendar_obj.send_autotext_days and calendar_obj.autotext_days_in_advance):
+            logger.info(f"Skipping calendar {calendar_obj} - autotext disabled.")
+            continue
+        if now().strftime("%w") not in calendar_obj.send_autotext_days:
+            if include_all:
+                logger.info(f"Ordinarily {calendar_obj} would not send a text today, but this is a test.")
+            else:
+                logger.info(f'Skipping calendar {calendar_obj} - autotext does not run on {now().strftime("%A")}')
+                continue
+        calendar_objs.append(calendar_obj)
+    return calendar_objs
+
+
+def horizon(calendar_obj, start_dt):
+    return start_dt + datetime.timedelta(days=calendar_obj.autotext_days_in_advance)
+
+
+def fetch_calendar_events(calendar_obj, start_dt):
+    """Returns the raw events for a single calendar's autotext, starting from ``start_dt``."""
+    return list(
+        google.calendar.iter_events(
+            calendar_obj.calendar_id,
+            start_dt=start_dt,
+            end_dt=horizon(calendar_obj, start_dt),
+            fields=google.EVENT_FIELDS,
+        )
+    )
+
+
+def summary_events(calendar_obj, events, start_dt):
+    """Normalizes the timed events from ``events`` that fall within the calendar's autotext horizon."""
+    event_horizon = horizon(calendar_obj, start_dt)
+    normalized_events = [
+        normalize_event(event)
+        for event in events
+        if "dateTime" in event["start"] and parse(event["start"]["dateTime"]) < event_horizon
+    ]
+    if not normalized_events:
+        logger.warning(f"No events in the next {calendar_obj.autotext_days_in_advance} days for {calendar_obj}")
+    return normalized_events
+
+
+def upcoming_events(calendar_objs):
+    """Returns a dict of calendar to its normalized events within its autotext horizon, leaving out
+    calendars with nothing coming up."""
+    if not calendar_objs:
+        return {}
+    start_dt = now()
+    events = defaultdict(list)
+    for calendar_id, event in google.fetch_upcoming_events(
+        [calendar_obj.calendar_id for calendar_obj in calendar_objs],
+        start_dt=start_dt,
+        end_dt=max(horizon(calendar_obj, start_dt) for calendar_obj in calendar_objs),
+    ):
+        events[calendar_id].append(event)
+
+    calendar_events = {}
+    for calendar_obj in calendar_objs:
+        normalized_events = summary_events(calendar_obj, events[calendar_obj.calendar_id], start_dt)
+        if normalized_events:
+            calendar_events[calendar_obj] = normalized_events
+    return calendar_events
+
+
+def render_summary(calendar_events, contact_method, extra_context=None):
+    """Renders the message covering the given calendars' events, returning the content and the email
+    subject. A single calendar gets its own message; several are combined into a digest."""
+    method_name = dict(models.CONTACT_PREFERENCES)[contact_method].lower()
+    today = Template('{{ timestamp|date:"DATE_FORMAT" }}').render(Context(dict(timestamp=now())))
+    context = dict(extra_context or dict())
+    if len(calendar_events) == 1:
+        [(calendar_obj, events)] = calendar_events
+        context.update(calendar=calendar_obj, events=events)
+        template_path = f"events/autotext/{method_name}.txt"
+        email_subject = f"Upcoming {calendar_obj.name} - {today}"
+    else:
+        context.update(
+            sections=[dict(calendar=calendar_obj, events=events) for calendar_obj, events in calendar_events]
+        )
+        template_path = f"events/autotext/digest_{method_name}.txt"
+        email_subject = f"Upcoming events - {today}"
+    # The shared footers end in a newline of their own
+    return loader.render_to_string(template_path, context).rstrip() + "\n", email_subject
+
+
+def queue_messages(human_ids, contact_method, content, email_subject, run_date=None, calendar_ids=()):
+    """Queues the message for everyone in ``human_ids``, sending each chunk of emails over one connection.
+    With a ``run_date``, each chunk is recorded in the dispatch ledger as it's queued."""
+    for i in range(0, len(human_ids), SEND_CHUNK_SIZE):
+        chunk = human_ids[i : i + SEND_CHUNK_SIZE]  # noqa: E203
+        with transaction.atomic():
+            if run_date:
+                models.AutotextDispatch.objects.bulk_create(
+                    [
+                        models.AutotextDispatch(
+                            run_date=run_date,
+                            calendar_id=calendar_id,
+                            human_id=human_id,
+                            contact_method=contact_method,
+                        )
+                        for human_id in chunk
+                        for calendar_id in calendar_ids
+                    ],
+                    ignore_conflicts=True,
+                )
+            if contact_method == constants.EMAIL:
+                tasks.send_email_batch.delay([(human_id, email_subject, content) for human_id in chunk])
+            else:
+                group(
+                    tasks.send_message.s(human_id, contact_method, content, email_subject) for human_id in chunk
+                ).apply_async()
+
+
+def send_digests(calendar_events, contact_methods, test_human=None, extra_context=None, run_date=None):
+    """Sends everyone one message per contact method covering every calendar in ``calendar_events`` they're
+    subscribed to. Each distinct combination of calendars is only rendered once. With a ``run_date``,
+    calendars already in that day's dispatch ledger are left out, and what's sent is added to it."""
+    # (human, contact method) -> calendars they get, then (calendars, contact method) -> humans
+    subscriptions = defaultdict(list)
+    if test_human:
+        logger.info(f"Sending test messages to {test_human}")
+        for contact_method in contact_methods:
+            subscriptions[(test_human.id, contact_method)] = [
+                calendar_obj.calendar_id for calendar_obj in sorted(calendar_events, key=lambda obj: obj.name)
+            ]
+    else:
+        for human_id, contact_method, calendar_id in (
+            models.HumanCalendarSubscription.objects.filter(
+                calendar__in=list(calendar_events), contact_method__in=contact_methods
+            )
+            .order_by("calendar__name")
+            .values_list("human_id", "contact_method", "calendar_id")
+        ):
+            subscriptions[(human_id, contact_method)].append(calendar_id)
+    if run_date:
+        for dispatch in models.AutotextDispatch.objects.filter(
+            run_date=run_date, calendar__in=list(calendar_events), contact_method__in=contact_methods
+        ).values_list("human_id", "contact_method", "calendar_id"):
+            if dispatch[2] in subscriptions.get(dispatch[:2], []):
+                subscriptions[dispatch[:2]].remove(dispatch[2])
+    recipients = defaultdict(list)
+    for (human_id, contact_method), calendar_ids in subscriptions.items():
+        if calendar_ids:
+            recipients[(tuple(calendar_ids), contact_method)].append(human_id)
+
+    sections_by_id = {obj.calendar_id: (obj, events) for obj, events in calendar_events.items()}
+    for (calendar_ids, contact_method), human_ids in recipients.items():
+        sections = [sections_by_id[calendar_id] for calendar_id in calendar_ids]
+        logger.debug(
+            f"Sending event summary for {', '.join(calendar_obj.name for calendar_obj, _ in sections)} "
+            f"to {len(human_ids)} human(s) via {dict(models.CONTACT_PREFERENCES)[contact_method]}"
+        )
+        content, email_subject = render_summary(sections, contact_method, extra_context)
+        queue_messages(human_ids, contact_method, content, email_subject, run_date, calendar_ids)
+
+
+def send_autotext(contact_methods=(constants.EMAIL, constants.SMS), test_human=None, extra_context=None, resume=False):
+    """Sends the day's autotext. Test messages bypass the dispatch ledger; otherwise, if today's run has
+    already started, this raises AlreadySent unless ``resume`` is given, in which case only the people who
+    haven't been sent it yet get it."""
+    run_date = None if test_human else localdate()
+    if run_date and not resume and models.AutotextDispatch.objects.filter(run_date=run_date).exists():
+        raise AlreadySent(f"Autotext has already been sent on {run_date}.")
+    calendar_events = upcoming_events(due_calendars(include_all=bool(test_human)))
+    send_digests(
+        calendar_events, contact_methods, test_human=test_human, extra_context=extra_context, run_date=run_date
+    )
@@ -1,36 +1,137 @@
 import base64
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
 import datetime
+import heapq
+import itertools
 import logging
 import os
 import pickle
+import threading
 
-from googleapiclient.discovery import build
+from dateutil import parser
+from django.conf import settings
+from googleapiclient.discovery import build_from_document
 from googleapiclient import errors
+from google.auth import exceptions as auth_exceptions
 from google.auth.transport.requests import Request
-from pytz import utc
+from pytz import timezone, utc
 
 logger = logging.getLogger(__name__)
 
+# Google recommends keeping Calendar API batches at or under 50 requests
+BATCH_SIZE = 50
 
-class Calendar(object):
-    _service = None
+DEFAULT_PAGE_SIZE = 250
+MAX_PAGE_SIZE = 2500
+
+# The parts of an event the check-in screens and autotext actually use
+EVENT_FIELDS = "id,status,summary,description,location,start,end,recurringEventId,hangoutLink"
+
+# How long fetch_upcoming_events waits on Google, in seconds, for all calendars together
+FANOUT_TIMEOUT = 10.0
+FANOUT_WORKERS = 8
+
+
+TOKEN_FILE = os.path.join(os.path.dirname(__file__), "token.pickle")
+# Saved from https://www.googleapis.com/discovery/v1/apis/calendar/v3/rest; fetch it again from there to update it
+DISCOVERY_FILE = os.environ.get("GOOGLE_DISCOVERY_FILE", os.path.join(os.path.dirname(__file__), "calendar.v3.json"))
+
+# Renew the OAuth token this many seconds before it expires, and retry this often if that fails
+TOKEN_REFRESH_MARGIN = 60 * 5
+TOKEN_REFRESH_RETRY = 60
+
+
+class SyncTokenExpired(ValueError):
+    pass
+
+
+_lock = threading.Lock()
+_local = threading.local()
+_token = None
+_discovery_document = None
+
+
+def _load_token():
+    if os.environ.get("GOOGLE_TOKEN"):
+        return pickle.loads(base64.decodebytes(bytes(os.environ["GOOGLE_TOKEN"], "utf-8")))
+    with open(TOKEN_FILE, "rb") as token_file:
+        return pickle.load(token_file)
+
+
+def _save_token(token):
+    if os.environ.get("GOOGLE_TOKEN"):
+        # Nowhere to write it back to; the refresh token in the environment keeps working regardless
+        return
+    try:
+        with open(TOKEN_FILE, "wb") as token_file:
+            pickle.dump(token, token_file)
+    except OSError:
+        logger.exception("Could not save refreshed Google token.")
+
+
+def _refresh_token():
+    try:
+        _token.refresh(Request())
+    except (auth_exceptions.RefreshError, auth_exceptions.TransportError):
+        logger.exception(f"Error refreshing Google token. Retrying in {TOKEN_REFRESH_RETRY} seconds.")
+        _schedule_refresh(TOKEN_REFRESH_RETRY)
+        return
+    logger.info("Refreshed Google token.")
+    _save_token(_token)
+    _schedule_refresh()
+
+
+def _schedule_refresh(delay=None):
+    if delay is None:
+        if not _token.expiry:
+            return
+        delay = max((_token.expiry - datetime.datetime.utcnow()).total_seconds() - TOKEN_REFRESH_MARGIN, 0)
+    timer = threading.Timer(delay, _refresh_token)
+    timer.daemon = True
+    timer.start()
 
+
+def get_token():
+    """Returns the process-wide OAuth token. It's renewed in the background shortly before it expires, so
+    API calls never have to wait on a refresh."""
+    global _token
+    with _lock:
+        if _token is None:
+            token = _load_token()
+            if not token or not token.valid:
+                if token and token.expired and token.refresh_token:
+                    token.refresh(Request())
+                    _save_token(token)
+                else:
+                    raise ValueError("Token is not valid.")
+            _token = token
+            _schedule_refresh()
+    return _token
+
+
+def get_discovery_document():
+    """Returns the Calendar API discovery document. It's read from DISCOVERY_FILE, which is committed next to
+    this module, so building a client never has to ask Google for it."""
+    global _discovery_document
+    with _lock:
+        if _discovery_document is None:
+            with open(DISCOVERY_FILE) as discovery_file:
+                _discovery_document = discovery_file.read()
+    return _discovery_document
+
+
+def get_service():
+    """Returns this thread's Calendar API client. httplib2 isn't thread-safe, so every thread builds its
+    own, but they all share one discovery document and token."""
+    if not hasattr(_local, "service"):
+        _local.service = build_from_document(get_discovery_document(), credentials=get_token())
+    return _local.service
+
+
+class Calendar(object):
     @property
     def service(self):
-        if self._service:
-            return self._service
-        if os.environ.get("GOOGLE_TOKEN"):
-            self.token = pickle.loads(base64.decodebytes(bytes(os.environ["GOOGLE_TOKEN"], "utf-8")))
-        else:
-            token_file = os.path.join(os.path.dirname(__file__), "token.pickle")
-            self.token = pickle.load(open(token_file, "rb"))
-        if not self.token or not self.token.valid:
-            if self.token and self.token.expired and self.token.refresh_token:
-                self.token.refresh(Request())
-            else:
-                raise ValueError("Token is not valid.")
-        self._service = build("calendar", "v3", credentials=self.token)
-        return self._service
+        return get_service()
 
     def get_calendar(self, calendar_id):
         try:
@@ -40,49 +141,217 @@ class Calendar(object):
         return result
 
     def get_event(self, calendar_id, event_id):
+        from .models import CalendarEvent
+
+        mirrored = CalendarEvent.objects.active().filter(calendar_id=calendar_id, event_id=event_id).first()
+        if mirrored:
+            return mirrored.data
         try:
             result = self.service.events().get(calendarId=calendar_id, eventId=event_id).execute()
         except errors.HttpError as e:
             raise ValueError(f"Invalid event ID reference: {e.args}")
         return result
 
-    def get_recurring_events(self, calendar_id, recurring_event_id, start_dt=None, count=25):
-        time_min = start_dt.astimezone(utc).replace(tzinfo=None).isoformat() + "Z" if start_dt else None
+    def get_events(self, calendar_id, event_ids):
+        """Looks up several events at once, returning a dict of event ID to event. Events missing from the
+        local mirror are fetched with batched API requests, and events that can't be found are left out."""
+        from .models import CalendarEvent
+
+        events = {
+            event_obj.event_id: event_obj.data
+            for event_obj in CalendarEvent.objects.active().filter(calendar_id=calendar_id, event_id__in=event_ids)
+        }
+        missing = [event_id for event_id in set(event_ids) if event_id not in events]
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                logger.warning(f"Could not look up event {request_id} on {calendar_id}: {exception}")
+            else:
+                events[request_id] = response
+
+        for i in range(0, len(missing), BATCH_SIZE):
+            batch = self.service.new_batch_http_request(callback=callback)
+            for event_id in missing[i : i + BATCH_SIZE]:  # noqa: E203
+                batch.add(self.service.events().get(calendarId=calendar_id, eventId=event_id), request_id=event_id)
+            try:
+                batch.execute()
+            except errors.HttpError as e:
+                raise ValueError(f"Invalid event lookup: {e.args}")
+        return events
+
+    def _pages(self, list_method, **kwargs):
+        page_token = None
+        while True:
+            result = list_method(pageToken=page_token, **kwargs).execute()
+            yield result
+            page_token = result.get("nextPageToken")
+            if not page_token:
+                return
+
+    def iter_recurring_events(self, calendar_id, recurring_event_id, start_dt=None):
+        """Yields each occurrence of a recurring event that ends after ``start_dt``. Occurrences are worked
+        out locally from the event's recurrence rules, so this only calls the API when the series isn't
+        cached yet."""
+        from .models import CalendarEventSeries
+
+        yield from CalendarEventSeries.get_series(calendar_id, recurring_event_id).occurrences(start_dt)
+
+    def get_series(self, calendar_id, recurring_event_id):
+        """Returns a recurring event along with its exceptions: the occurrences that have been moved, edited
+        or cancelled."""
         try:
-            result = (
-                self.service.events()
-                .instances(calendarId=calendar_id, eventId=recurring_event_id, timeMin=time_min, maxResults=count)
-                .execute()
+            event = self.service.events().get(calendarId=calendar_id, eventId=recurring_event_id).execute()
+            pages = self._pages(
+                self.service.events().list,
+                calendarId=calendar_id,
+                iCalUID=event["iCalUID"],
+                showDeleted=True,
+                maxResults=MAX_PAGE_SIZE,
             )
+            exceptions = [item for page in pages for item in page.get("items", []) if "originalStartTime" in item]
         except errors.HttpError as e:
             raise ValueError(f"Invalid recurring event lookup: {e.args}")
-        return result.get("items", [])
+        return event, exceptions
+
+    def get_recurring_events(self, calendar_id, recurring_event_id, start_dt=None, count=25):
+        return list(itertools.islice(self.iter_recurring_events(calendar_id, recurring_event_id, start_dt), count))
+
+    def iter_events(self, calendar_id, start_dt=None, end_dt=None, page_size=DEFAULT_PAGE_SIZE, fields=None):
+        """Yields the events between ``start_dt`` (default now) and ``end_dt`` in start order, fetching
+        further pages only as they're needed. ``fields`` narrows each event down to the given fields (in
+        the API's field mask syntax) when it has to come from the API."""
+        from .models import CalendarEvent
 
-    def get_upcoming_events(self, calendar_id, start_dt=None, end_dt=None, count=25):
         if start_dt is None:
-            start_dt = datetime.datetime.utcnow()
+            start_dt = utc.localize(datetime.datetime.utcnow())
+        if CalendarEvent.objects.is_mirrored(calendar_id):
+            mirrored = CalendarEvent.objects.active().filter(calendar_id=calendar_id, end__gt=start_dt)
+            if end_dt:
+                mirrored = mirrored.filter(start__lt=end_dt)
+            for event_obj in mirrored.order_by("start").iterator(chunk_size=page_size):
+                yield event_obj.data
         else:
-            if start_dt.tzinfo is not None:
-                start_dt = start_dt.astimezone(utc)
-                start_dt = start_dt.replace(tzinfo=None)
-        time_min = start_dt.isoformat() + "Z"
-        time_max = end_dt.astimezone(utc).replace(tzinfo=None).isoformat() + "Z" if end_dt else None
+            yield from self.iter_api_events(calendar_id, start_dt, end_dt, page_size, fields)
+
+    def iter_api_events(self, calendar_id, start_dt, end_dt=None, page_size=DEFAULT_PAGE_SIZE, fields=None):
+        """Like iter_events, but always asks the API and never touches the database."""
+        pages = self._pages(
+            self.service.events().list,
+            calendarId=calendar_id,
+            timeMin=_timestamp(start_dt),
+            timeMax=_timestamp(end_dt) if end_dt else None,
+            maxResults=page_size,
+            singleEvents=True,
+            orderBy="startTime",
+            fields=f"nextPageToken,items({fields})" if fields else None,
+        )
+        try:
+            for page in pages:
+                yield from page.get("items", [])
+        except errors.HttpError as e:
+            raise ValueError(f"Invalid event lookup: {e.args}")
+
+    def get_upcoming_events(self, calendar_id, start_dt=None, end_dt=None, count=25):
+        return list(itertools.islice(self.iter_events(calendar_id, start_dt, end_dt, page_size=count), count))
+
+    def watch_events(self, calendar_id, channel_id, address, token, ttl):
         try:
             result = (
                 self.service.events()
-                .list(
+                .watch(
                     calendarId=calendar_id,
-                    timeMin=time_min,
-                    timeMax=time_max,
-                    maxResults=count,
-                    singleEvents=True,
-                    orderBy="startTime",
+                    body=dict(
+                        id=channel_id,
+                        type="web_hook",
+                        address=address,
+                        token=token,
+                        params=dict(ttl=str(int(ttl.total_seconds()))),
+                    ),
                 )
                 .execute()
             )
         except errors.HttpError as e:
-            raise ValueError(f"Invalid event lookup: {e.args}")
-        return result.get("items", [])
+            raise ValueError(f"Could not watch calendar: {e.args}")
+        return result
+
+    def stop_channel(self, channel_id, resource_id):
+        try:
+            self.service.channels().stop(body=dict(id=channel_id, resourceId=resource_id)).execute()
+        except errors.HttpError as e:
+            raise ValueError(f"Could not stop channel: {e.args}")
+
+    def list_changed_events(self, calendar_id, sync_token=None):
+        """Returns every event changed since ``sync_token`` was issued, or every event on the calendar
+        when no token is given, along with the token to pass in for the next incremental sync."""
+        events = []
+        pages = self._pages(
+            self.service.events().list,
+            calendarId=calendar_id,
+            syncToken=sync_token,
+            maxResults=MAX_PAGE_SIZE,
+            singleEvents=True,
+        )
+        try:
+            for page in pages:
+                events += page.get("items", [])
+        except errors.HttpError as e:
+            if e.resp.status == 410:
+                raise SyncTokenExpired(f"Sync token for {calendar_id} is no longer valid.")
+            raise ValueError(f"Invalid event sync: {e.args}")
+        return events, page.get("nextSyncToken")
+
+
+def event_datetime(value):
+    if "dateTime" in value:
+        return parser.parse(value["dateTime"])
+    if "date" in value:
+        return timezone(settings.TIME_ZONE).localize(parser.parse(value["date"]))
+    return None
+
+
+def _timestamp(dt):
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(utc).replace(tzinfo=None)
+    return dt.isoformat() + "Z"
 
 
 calendar = Calendar()
+
+_executor = None
+
+
+def _fetch_api_events(calendar_id, start_dt, end_dt, fields):
+    return list(calendar.iter_api_events(calendar_id, start_dt, end_dt, fields=fields))
+
+
+def fetch_upcoming_events(calendar_ids, start_dt=None, end_dt=None, fields=EVENT_FIELDS, timeout=FANOUT_TIMEOUT):
+    """Fetches the events between ``start_dt`` and ``end_dt`` for several calendars at once, and returns
+    them as (calendar ID, event) pairs in start order. Mirrored calendars are read locally; the rest are
+    queried in parallel, and any that fail or haven't answered within ``timeout`` seconds are logged and
+    left out."""
+    from .models import CalendarEvent
+
+    global _executor
+    if start_dt is None:
+        start_dt = utc.localize(datetime.datetime.utcnow())
+    results = []
+    futures = {}
+    for calendar_id in calendar_ids:
+        if CalendarEvent.objects.is_mirrored(calendar_id):
+            results.append([(calendar_id, event) for event in calendar.iter_events(calendar_id, start_dt, end_dt)])
+            continue
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="calendar-fetch")
+        futures[_executor.submit(_fetch_api_events, calendar_id, start_dt, end_dt, fields)] = calendar_id
+    try:
+        for future in as_completed(futures, timeout=timeout):
+            calendar_id = futures.pop(future)
+            try:
+                results.append([(calendar_id, event) for event in future.result()])
+            except ValueError:
+                logger.exception(f"Error fetching upcoming events for {calendar_id}")
+    except TimeoutError:
+        for future, calendar_id in futures.items():
+            future.cancel()
+            logger.error(f"Timed out fetching upcoming events for {calendar_id}")
+    return list(heapq.merge(*results, key=lambda result: event_datetime(result[1]["start"])))
@@ -0,0 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from django.core.management import BaseCommand
+from django.db import connection
+
+from events import models, google
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Fill in the event snapshot on attendance records checked in before it was stored"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", action="store", type=int, default=google.BATCH_SIZE)
+        parser.add_argument("--concurrency", action="store", type=int, default=4)
+
+    def handle(self, *args, **options):
+        def fill_batch(ids):
+            try:
+                attendances = models.HumanAttendance.resolve_events(models.HumanAttendance.objects.filter(pk__in=ids))
+                found = [attendance for attendance in attendances if attendance.event]
+                for attendance in found:
+                    attendance.apply_event(attendance.event)
+                models.HumanAttendance.objects.bulk_update(found, models.HumanAttendance.SNAPSHOT_FIELDS)
+                return len(found), len(attendances) - len(found)
+            finally:
+                connection.close()
+
+        ids = list(
+            models.HumanAttendance.objects.filter(event_summary="")
+            .exclude(event_id="")
+            .order_by("calendar", "event_id")
+            .values_list("pk", flat=True)
+        )
+        logger.info(f"Backfilling event details for {len(ids)} attendance record(s)")
+        batches = [ids[i : i + options["batch_size"]] for i in range(0, len(ids), options["batch_size"])]  # noqa: E203
+        filled = missing = 0
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as executor:
+            for batch_filled, batch_missing in executor.map(fill_batch, batches):
+                filled += batch_filled
+                missing += batch_missing
+        logger.info(f"Filled in {filled} attendance record(s); {missing} had events that could not be found.")
@@ -0,0 +1,46 @@
+import logging
+
+from django.core.management import BaseCommand, CommandError
+from django.test import Client
+import requests
+
+from events import models
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Stand in for Google and send a calendar change notification to the webhook"
+
+    def add_arguments(self, parser):
+        parser.add_argument("calendar_id")
+        parser.add_argument("--state", action="store", default="exists", choices=["sync", "exists", "not_exists"])
+        parser.add_argument(
+            "--url", action="store", help="Post to a running server at this URL instead of handling it in-process."
+        )
+
+    def handle(self, *args, **options):
+        try:
+            calendar_obj = models.Calendar.objects.get(calendar_id=options["calendar_id"])
+        except models.Calendar.DoesNotExist:
+            raise CommandError(f"Unknown calendar {options['calendar_id']}")
+        if not calendar_obj.watch_channel_id:
+            logger.info(f"{calendar_obj} has no watch channel yet, setting one up.")
+            calendar_obj.watch()
+        headers = {
+            "X-Goog-Channel-ID": calendar_obj.watch_channel_id,
+            "X-Goog-Channel-Token": calendar_obj.watch_token,
+            "X-Goog-Resource-ID": calendar_obj.watch_resource_id,
+            "X-Goog-Resource-State": options["state"],
+            "X-Goog-Message-Number": "1",
+        }
+        if options["url"]:
+            response = requests.post(options["url"], headers=headers, timeout=10)
+            status_code, content = response.status_code, response.text
+        else:
+            response = Client(HTTP_HOST="127.0.0.1").post(
+                "/webhooks/google-calendar/",
+                **{"HTTP_" + name.upper().replace("-", "_"): value for name, value in headers.items()},
+            )
+            status_code, content = response.status_code, response.content.decode()
+        logger.info(f"Webhook responded ({status_code}) {content}")
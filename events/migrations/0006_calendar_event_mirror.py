@@ -0,0 +1,40 @@
+# Generated by Django 2.2.14 on 2026-10-18 02:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("events", "0005_auto_20190321_1837"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="calendar",
+            name="last_synced",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="calendar",
+            name="sync_token",
+            field=models.CharField(blank=True, editable=False, max_length=250),
+        ),
+        migrations.CreateModel(
+            name="CalendarEvent",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("event_id", models.CharField(max_length=250)),
+                ("recurring_event_id", models.CharField(blank=True, db_index=True, max_length=250)),
+                ("status", models.CharField(max_length=20)),
+                ("summary", models.CharField(blank=True, max_length=250)),
+                ("start", models.DateTimeField(blank=True, null=True)),
+                ("end", models.DateTimeField(blank=True, null=True)),
+                ("updated", models.DateTimeField(blank=True, null=True)),
+                ("raw", models.TextField()),
+                ("calendar", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="events.Calendar")),
+            ],
+            options={"unique_together": {("calendar", "event_id")}, "index_together": {("calendar", "start")},},
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2.14 on 2026-10-18 02:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("events", "0006_calendar_event_mirror"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="humanattendance",
+            name="event_end",
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name="Event end"),
+        ),
+        migrations.AddField(
+            model_name="humanattendance",
+            name="event_location",
+            field=models.CharField(blank=True, editable=False, max_length=250),
+        ),
+        migrations.AddField(
+            model_name="humanattendance",
+            name="event_start",
+            field=models.DateTimeField(blank=True, editable=False, null=True, verbose_name="Event start"),
+        ),
+        migrations.AddField(
+            model_name="humanattendance",
+            name="event_summary",
+            field=models.CharField(blank=True, editable=False, max_length=250, verbose_name="Event"),
+        ),
+    ]
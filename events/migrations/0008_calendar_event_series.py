@@ -0,0 +1,26 @@
+# Generated by Django 2.2.14 on 2026-10-18 02:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("events", "0007_humanattendance_event_snapshot"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="CalendarEventSeries",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("event_id", models.CharField(max_length=250)),
+                ("raw", models.TextField()),
+                ("raw_exceptions", models.TextField()),
+                ("fetched", models.DateTimeField(auto_now=True)),
+                ("calendar", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="events.Calendar")),
+            ],
+            options={"verbose_name_plural": "Calendar event series", "unique_together": {("calendar", "event_id")},},
+        ),
+    ]
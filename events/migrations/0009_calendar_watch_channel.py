@@ -0,0 +1,33 @@
+# Generated by Django 2.2.14 on 2026-10-18 02:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("events", "0008_calendar_event_series"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="calendar",
+            name="watch_channel_id",
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=64),
+        ),
+        migrations.AddField(
+            model_name="calendar",
+            name="watch_expiration",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="calendar",
+            name="watch_resource_id",
+            field=models.CharField(blank=True, editable=False, max_length=250),
+        ),
+        migrations.AddField(
+            model_name="calendar",
+            name="watch_token",
+            field=models.CharField(blank=True, editable=False, max_length=64),
+        ),
+    ]
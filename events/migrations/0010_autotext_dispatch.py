@@ -0,0 +1,27 @@
+# Generated by Django 2.2.14 on 2026-10-18 02:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("seekers", "0019_auto_20200708_2317"),
+        ("events", "0009_calendar_watch_channel"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AutotextDispatch",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("run_date", models.DateField()),
+                ("contact_method", models.IntegerField(choices=[(1, "Email"), (2, "SMS")])),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("calendar", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="events.Calendar")),
+                ("human", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="seekers.Human")),
+            ],
+            options={"unique_together": {("run_date", "calendar", "human", "contact_method")},},
+        ),
+    ]
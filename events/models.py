@@ -1,17 +1,27 @@
+from collections import defaultdict
+import datetime
+import json
 import logging
+import secrets
+import uuid
 
-from django.db import models
+from dateutil import parser, rrule, tz
+from django.conf import settings
+from django.db import models, transaction
 from django.core.exceptions import ValidationError
-from django.template import Context, Template, loader
 from django.utils.functional import cached_property
 from django.utils.timezone import now
 from multiselectfield import MultiSelectField
+from pytz import timezone, utc
 
-from seekers import tasks, constants
+from seekers import constants
 from . import google
 
 logger = logging.getLogger(__name__)
 
+# How long a push notification channel lasts; Google caps this at a week
+WATCH_CHANNEL_TTL = datetime.timedelta(days=7)
+
 DAYS_OF_WEEK = [
     (0, "Sunday"),
     (1, "Monday"),
@@ -30,6 +40,12 @@ class Calendar(models.Model):
     track_attendance = models.BooleanField(default=False)
     send_autotext_days = MultiSelectField(choices=DAYS_OF_WEEK, blank=True)
     autotext_days_in_advance = models.PositiveIntegerField(null=True, blank=True)
+    sync_token = models.CharField(max_length=250, blank=True, editable=False)
+    last_synced = models.DateTimeField(blank=True, null=True, editable=False)
+    watch_channel_id = models.CharField(max_length=64, blank=True, editable=False, db_index=True)
+    watch_resource_id = models.CharField(max_length=250, blank=True, editable=False)
+    watch_token = models.CharField(max_length=64, blank=True, editable=False)
+    watch_expiration = models.DateTimeField(blank=True, null=True, editable=False)
 
     def __str__(self):
         return self.name
@@ -42,6 +58,220 @@ class Calendar(models.Model):
         else:
             self.name = calendar_obj["summary"]
 
+    def is_watched(self):
+        return bool(self.watch_channel_id and self.watch_expiration and self.watch_expiration > now())
+
+    def watch(self):
+        """Sets up a new push notification channel for changes to this calendar, replacing the current one.
+        Without a GOOGLE_CALENDAR_WEBHOOK_URL, in DEBUG, the channel is only recorded locally so that the
+        notifycalendar command can stand in for Google."""
+        channel_id = uuid.uuid4().hex
+        token = secrets.token_hex(16)
+        if settings.GOOGLE_CALENDAR_WEBHOOK_URL:
+            channel = google.calendar.watch_events(
+                self.calendar_id, channel_id, settings.GOOGLE_CALENDAR_WEBHOOK_URL, token, WATCH_CHANNEL_TTL
+            )
+            resource_id = channel["resourceId"]
+            expiration = datetime.datetime.fromtimestamp(int(channel["expiration"]) / 1000, utc)
+        elif settings.DEBUG:
+            resource_id = f"local-{channel_id}"
+            expiration = now() + WATCH_CHANNEL_TTL
+        else:
+            logger.warning("GOOGLE_CALENDAR_WEBHOOK_URL is not set, so calendar changes can't be watched.")
+            return
+        old_channel = (self.watch_channel_id, self.watch_resource_id)
+        self.watch_channel_id, self.watch_resource_id = channel_id, resource_id
+        self.watch_token, self.watch_expiration = token, expiration
+        self.save(update_fields=["watch_channel_id", "watch_resource_id", "watch_token", "watch_expiration"])
+        self.stop_watching(*old_channel)
+
+    def stop_watching(self, channel_id=None, resource_id=None):
+        if channel_id is None:
+            channel_id, resource_id = self.watch_channel_id, self.watch_resource_id
+            self.watch_channel_id = self.watch_resource_id = self.watch_token = ""
+            self.watch_expiration = None
+            self.save(update_fields=["watch_channel_id", "watch_resource_id", "watch_token", "watch_expiration"])
+        if channel_id and not resource_id.startswith("local-"):
+            try:
+                google.calendar.stop_channel(channel_id, resource_id)
+            except ValueError:
+                # It'll expire on its own, and notifications for unknown channels are ignored
+                logger.warning(f"Could not stop watch channel {channel_id} for {self}")
+
+    def sync_events(self):
+        full_sync = not self.sync_token
+        try:
+            events, sync_token = google.calendar.list_changed_events(self.calendar_id, self.sync_token or None)
+        except google.SyncTokenExpired:
+            logger.warning(f"Sync token for {self} expired, falling back to a full sync.")
+            full_sync = True
+            events, sync_token = google.calendar.list_changed_events(self.calendar_id)
+        logger.info(f"Syncing {len(events)} changed event(s) for {self} ({'full' if full_sync else 'incremental'})")
+
+        # Later pages can repeat an event, in which case the last copy is the current one
+        changed = {event["id"]: CalendarEvent.from_api(self, event) for event in events}
+        with transaction.atomic():
+            # Serialise concurrent syncs of the same calendar
+            type(self).objects.select_for_update().get(pk=self.pk)
+            if full_sync:
+                self.calendarevent_set.all().delete()
+                existing = {}
+            else:
+                existing = {
+                    event_obj.event_id: event_obj
+                    for event_obj in self.calendarevent_set.filter(event_id__in=list(changed.keys()))
+                }
+            to_update = []
+            for event_id, event_obj in changed.items():
+                if event_id in existing:
+                    event_obj.pk = existing[event_id].pk
+                    to_update.append(event_obj)
+            CalendarEvent.objects.bulk_create([obj for obj in changed.values() if obj.event_id not in existing])
+            CalendarEvent.objects.bulk_update(to_update, CalendarEvent.MIRRORED_FIELDS)
+            # Any change to a recurring event shows up as changes to its occurrences
+            stale_series = self.calendareventseries_set.all()
+            if not full_sync:
+                stale_series = stale_series.filter(
+                    event_id__in={obj.recurring_event_id or obj.event_id for obj in changed.values()}
+                )
+            stale_series.delete()
+            self.sync_token = sync_token or ""
+            self.last_synced = now()
+            self.save(update_fields=["sync_token", "last_synced"])
+
+
+class CalendarEventQuerySet(models.QuerySet):
+    def active(self):
+        return self.exclude(status="cancelled")
+
+    def is_mirrored(self, calendar_id):
+        return Calendar.objects.filter(calendar_id=calendar_id, last_synced__isnull=False).exists()
+
+
+class CalendarEvent(models.Model):
+    """A local copy of a single Google Calendar event (recurring events are stored one row per occurrence),
+    kept current by Calendar.sync_events."""
+
+    MIRRORED_FIELDS = ["recurring_event_id", "status", "summary", "start", "end", "updated", "raw"]
+
+    calendar = models.ForeignKey(Calendar, on_delete=models.CASCADE)
+    event_id = models.CharField(max_length=250)
+    recurring_event_id = models.CharField(max_length=250, blank=True, db_index=True)
+    status = models.CharField(max_length=20)
+    summary = models.CharField(max_length=250, blank=True)
+    start = models.DateTimeField(blank=True, null=True)
+    end = models.DateTimeField(blank=True, null=True)
+    updated = models.DateTimeField(blank=True, null=True)
+    raw = models.TextField()
+
+    objects = CalendarEventQuerySet.as_manager()
+
+    @classmethod
+    def from_api(cls, calendar_obj, event):
+        return cls(
+            calendar=calendar_obj,
+            event_id=event["id"],
+            recurring_event_id=event.get("recurringEventId", ""),
+            status=event.get("status", ""),
+            summary=event.get("summary", "")[:250],
+            start=google.event_datetime(event.get("start", {})),
+            end=google.event_datetime(event.get("end", {})),
+            updated=parser.parse(event["updated"]) if event.get("updated") else None,
+            raw=json.dumps(event),
+        )
+
+    @cached_property
+    def data(self):
+        return json.loads(self.raw)
+
+    def __str__(self):
+        return self.summary or self.event_id
+
+    class Meta:
+        unique_together = [("calendar", "event_id")]
+        index_together = [("calendar", "start")]
+
+
+class CalendarEventSeries(models.Model):
+    """A cached copy of a recurring event and its exceptions (occurrences that were moved, edited or
+    cancelled), used to work out its occurrences locally instead of asking Google for them."""
+
+    # How long a cached series is trusted for calendars that aren't kept in sync
+    MAX_AGE = datetime.timedelta(days=1)
+
+    calendar = models.ForeignKey(Calendar, on_delete=models.CASCADE)
+    event_id = models.CharField(max_length=250)
+    raw = models.TextField()
+    raw_exceptions = models.TextField()
+    fetched = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def get_series(cls, calendar_id, event_id):
+        series_obj = cls.objects.filter(calendar_id=calendar_id, event_id=event_id).first()
+        if series_obj and (CalendarEvent.objects.is_mirrored(calendar_id) or series_obj.fetched > now() - cls.MAX_AGE):
+            return series_obj
+        event, exceptions = google.calendar.get_series(calendar_id, event_id)
+        series_obj, _ = cls.objects.update_or_create(
+            calendar_id=calendar_id,
+            event_id=event_id,
+            defaults=dict(raw=json.dumps(event), raw_exceptions=json.dumps(exceptions)),
+        )
+        return series_obj
+
+    @cached_property
+    def data(self):
+        return json.loads(self.raw)
+
+    @cached_property
+    def exceptions(self):
+        return {event["id"]: event for event in json.loads(self.raw_exceptions)}
+
+    def occurrences(self, start_dt=None):
+        """Yields the occurrences that end after ``start_dt`` (or all of them), in the same shape the
+        Calendar API gives event instances. This can go on forever for series without an end date."""
+        event = self.data
+        all_day = "date" in event["start"]
+        if all_day:
+            series_start = parser.parse(event["start"]["date"])
+            duration = parser.parse(event["end"]["date"]) - series_start
+        else:
+            event_tz = tz.gettz(event["start"].get("timeZone") or settings.TIME_ZONE)
+            series_start = parser.parse(event["start"]["dateTime"]).astimezone(event_tz)
+            duration = parser.parse(event["end"]["dateTime"]) - series_start
+        ruleset = rrule.rrulestr("\n".join(event.get("recurrence", [])), dtstart=series_start, forceset=True)
+        if start_dt is None:
+            original_starts = iter(ruleset)
+        else:
+            if all_day:
+                start_dt = start_dt.astimezone(timezone(settings.TIME_ZONE)).replace(tzinfo=None)
+            original_starts = ruleset.xafter(start_dt - duration, inc=False)
+
+        instance = {key: value for key, value in event.items() if key not in ("id", "recurrence")}
+        instance["recurringEventId"] = event["id"]
+        for original_start in original_starts:
+            if all_day:
+                event_id = f"{event['id']}_{original_start:%Y%m%d}"
+                original_start_time = start = dict(date=original_start.date().isoformat())
+                end = dict(date=(original_start + duration).date().isoformat())
+            else:
+                event_id = f"{event['id']}_{original_start.astimezone(utc):%Y%m%dT%H%M%SZ}"
+                original_start_time = start = dict(
+                    dateTime=original_start.isoformat(), timeZone=event["start"].get("timeZone")
+                )
+                end = dict(dateTime=(original_start + duration).isoformat(), timeZone=event["end"].get("timeZone"))
+            if event_id in self.exceptions:
+                if self.exceptions[event_id].get("status") != "cancelled":
+                    yield self.exceptions[event_id]
+                continue
+            yield dict(instance, id=event_id, originalStartTime=original_start_time, start=start, end=end)
+
+    def __str__(self):
+        return self.data.get("summary") or self.event_id
+
+    class Meta:
+        unique_together = [("calendar", "event_id")]
+        verbose_name_plural = "Calendar event series"
+
 
 class HumanAttendance(models.Model):
     human = models.ForeignKey("seekers.Human", verbose_name="Attendee", on_delete=models.CASCADE)
@@ -50,18 +280,60 @@ class HumanAttendance(models.Model):
     recurring_event_id = models.CharField(max_length=120, blank=True, db_index=True)
     created = models.DateTimeField(auto_now_add=True)
 
+    # A copy of the event details taken at check-in, so that listing attendance doesn't need Google
+    event_summary = models.CharField("Event", max_length=250, blank=True, editable=False)
+    event_start = models.DateTimeField("Event start", blank=True, null=True, editable=False)
+    event_end = models.DateTimeField("Event end", blank=True, null=True, editable=False)
+    event_location = models.CharField(max_length=250, blank=True, editable=False)
+
+    SNAPSHOT_FIELDS = ["event_summary", "event_start", "event_end", "event_location"]
+
     @cached_property
     def event(self):
         if not self.event_id:
             return {}
         try:
-            event_obj = google.calendar.get_event(self.calendar.calendar_id, self.event_id)
+            event_obj = google.calendar.get_event(self.calendar_id, self.event_id)
         except ValueError:
             return {}
         return event_obj
 
+    @classmethod
+    def resolve_events(cls, attendances):
+        """Fills in ``event`` for a batch of attendance records with one lookup per calendar, rather than
+        one per record. Records that already have an event snapshot are skipped. Returns the records as a
+        list."""
+        attendances = list(attendances)
+        event_ids = defaultdict(set)
+        for attendance in attendances:
+            if attendance.event_id and not attendance.event_summary:
+                event_ids[attendance.calendar_id].add(attendance.event_id)
+        events = {}
+        for calendar_id, calendar_event_ids in event_ids.items():
+            try:
+                found = google.calendar.get_events(calendar_id, list(calendar_event_ids))
+            except ValueError:
+                logger.exception(f"Error looking up events on {calendar_id}")
+                found = {}
+            events.update({(calendar_id, event_id): event for event_id, event in found.items()})
+        for attendance in attendances:
+            if attendance.event_id and not attendance.event_summary:
+                attendance.event = events.get((attendance.calendar_id, attendance.event_id), {})
+        return attendances
+
+    def apply_event(self, event):
+        self.event_summary = event.get("summary", "")[:250]
+        self.event_start = google.event_datetime(event.get("start", {}))
+        self.event_end = google.event_datetime(event.get("end", {}))
+        self.event_location = event.get("location", "")[:250]
+
+    def event_name(self):
+        return self.event_summary or self.event.get("summary") or "Unknown event"
+
+    event_name.short_description = "Event"
+
     def __str__(self):
-        return f'{self.human} went to {self.event.get("summary") or "Unknown event"}'
+        return f"{self.human} went to {self.event_name()}"
 
     class Meta:
         verbose_name = "Event attendance"
@@ -83,17 +355,23 @@ class HumanCalendarSubscription(models.Model):
     def __str__(self):
         return f"{self.human} subscribed to {self.calendar}"
 
-    def send_events_summary(self, events, extra_context=None):
-        logger.debug(f"Sending to event summary to {self.human} via {self.get_contact_method_display()}")
-        extra_context = extra_context or dict()
-        context = dict(human=self.human, events=events, calendar=self.calendar, **extra_context)
-        template_path = f"events/autotext/{self.get_contact_method_display().lower()}.txt"
-        template_obj = loader.get_template(template_path)
-        content = template_obj.render(context)
-        today = Template('{{ timestamp|date:"DATE_FORMAT" }}').render(Context(dict(timestamp=now())))
-        email_subject = f"Upcoming {self.calendar.name} - {today}"
-        tasks.send_message.delay(self.human.id, self.contact_method, content, email_subject)
-
     class Meta:
         unique_together = [("human", "calendar")]
         verbose_name = "Calendar subscription"
+
+
+class AutotextDispatch(models.Model):
+    """A record that a day's autotext for a calendar has been queued for someone, so that reruns don't send
+    it to them again."""
+
+    run_date = models.DateField()
+    calendar = models.ForeignKey(Calendar, on_delete=models.CASCADE)
+    human = models.ForeignKey("seekers.Human", on_delete=models.CASCADE)
+    contact_method = models.IntegerField(choices=CONTACT_PREFERENCES)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.calendar} autotext for {self.human} on {self.run_date}"
+
+    class Meta:
+        unique_together = [("run_date", "calendar", "human", "contact_method")]
@@ -0,0 +1,112 @@
+import datetime
+
+from celery import chord, shared_task
+from celery.utils.log import get_task_logger
+from dateutil.parser import parse
+from django.db.models import Q
+from django.utils.timezone import localdate, now
+
+from seekers import constants
+from . import autotext, models
+
+
+logger = get_task_logger(__name__)
+
+# Calendars with a live watch channel are still polled this often, in case a notification goes missing
+WATCHED_SYNC_INTERVAL = datetime.timedelta(hours=1)
+
+# Watch channels are replaced once they're this close to expiring
+WATCH_RENEWAL_MARGIN = datetime.timedelta(days=1)
+
+# Each calendar gets this many seconds to fetch its autotext events, and this many retries, before it's left out.
+# Every calendar's digest waits on the slowest, so retries back off from only a few seconds.
+AUTOTEXT_FETCH_TIME_LIMIT = 60
+AUTOTEXT_FETCH_RETRIES = 3
+AUTOTEXT_FETCH_BACKOFF = 5
+
+
+@shared_task
+def sync_calendar(calendar_id):
+    try:
+        calendar_obj = models.Calendar.objects.get(calendar_id=calendar_id)
+    except models.Calendar.DoesNotExist:
+        logger.warning(f"Tried syncing unknown calendar {calendar_id}")
+        return
+    calendar_obj.sync_events()
+
+
+@shared_task
+def sync_calendars():
+    unwatched = Q(watch_expiration__isnull=True) | Q(watch_expiration__lte=now())
+    stale = Q(last_synced__isnull=True) | Q(last_synced__lte=now() - WATCHED_SYNC_INTERVAL)
+    for calendar_id in models.Calendar.objects.filter(unwatched | stale, inactive_date__isnull=True).values_list(
+        "calendar_id", flat=True
+    ):
+        sync_calendar.delay(calendar_id)
+
+
+@shared_task
+def renew_calendar_watches():
+    for calendar_obj in models.Calendar.objects.filter(inactive_date__isnull=True).filter(
+        Q(watch_expiration__isnull=True) | Q(watch_expiration__lte=now() + WATCH_RENEWAL_MARGIN)
+    ):
+        logger.info(f"Renewing watch channel for {calendar_obj}")
+        try:
+            calendar_obj.watch()
+        except ValueError:
+            logger.exception(f"Could not watch {calendar_obj} for changes")
+    for calendar_obj in models.Calendar.objects.filter(inactive_date__isnull=False).exclude(watch_channel_id=""):
+        logger.info(f"Stopping watch channel for inactive {calendar_obj}")
+        calendar_obj.stop_watching()
+
+
+@shared_task
+def dispatch_autotext():
+    """Fetches every calendar due to send its autotext today in its own task, then sends the digests once
+    they've all finished."""
+    calendar_objs = autotext.due_calendars()
+    if not calendar_objs:
+        logger.info("No calendars send autotext today")
+        return
+    start = now().isoformat()
+    chord(fetch_autotext_events.s(calendar_obj.calendar_id, start) for calendar_obj in calendar_objs)(
+        send_autotext_digests.s(start)
+    )
+
+
+@shared_task(
+    bind=True,
+    max_retries=AUTOTEXT_FETCH_RETRIES,
+    soft_time_limit=AUTOTEXT_FETCH_TIME_LIMIT,
+    time_limit=AUTOTEXT_FETCH_TIME_LIMIT + 15,
+)
+def fetch_autotext_events(self, calendar_id, start):
+    try:
+        calendar_obj = models.Calendar.objects.get(calendar_id=calendar_id)
+        return calendar_id, autotext.fetch_calendar_events(calendar_obj, parse(start))
+    except models.Calendar.DoesNotExist:
+        logger.warning(f"Calendar {calendar_id} was removed before its autotext events could be fetched")
+        return calendar_id, []
+    except Exception as e:
+        # Any failure here would fail the whole chord, so anything that's still failing after the retries
+        # hands back an empty result instead, and the other calendars' autotext goes out
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=e, countdown=AUTOTEXT_FETCH_BACKOFF * 2 ** self.request.retries)
+        logger.exception(f"Giving up fetching autotext events for {calendar_id}")
+        return calendar_id, []
+
+
+@shared_task
+def send_autotext_digests(results, start):
+    start_dt = parse(start)
+    calendar_objs = models.Calendar.objects.in_bulk(
+        [calendar_id for calendar_id, _ in results], field_name="calendar_id"
+    )
+    calendar_events = {}
+    for calendar_id, events in results:
+        if calendar_id not in calendar_objs:
+            continue
+        normalized_events = autotext.summary_events(calendar_objs[calendar_id], events, start_dt)
+        if normalized_events:
+            calendar_events[calendar_objs[calendar_id]] = normalized_events
+    autotext.send_digests(calendar_events, (constants.EMAIL, constants.SMS), run_date=localdate(start_dt))
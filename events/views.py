@@ -0,0 +1,32 @@
+import hmac
+import logging
+
+from django.http import HttpResponse
+from django.views.decorators import csrf, http
+
+from .models import Calendar
+from . import tasks
+
+logger = logging.getLogger(__name__)
+
+
+@http.require_POST
+@csrf.csrf_exempt
+def google_calendar_webhook(request):
+    channel_id = request.META.get("HTTP_X_GOOG_CHANNEL_ID", "")
+    try:
+        calendar_obj = Calendar.objects.get(watch_channel_id=channel_id) if channel_id else None
+    except Calendar.DoesNotExist:
+        calendar_obj = None
+    if calendar_obj is None:
+        logger.warning(f"Notification received for unknown watch channel {channel_id}")
+        return HttpResponse(status=404, content="Unknown channel.")
+    if not hmac.compare_digest(request.META.get("HTTP_X_GOOG_CHANNEL_TOKEN", ""), calendar_obj.watch_token):
+        return HttpResponse(status=403, content="Channel token verification failed.")
+
+    # The first notification on a channel only confirms that it's set up
+    if request.META.get("HTTP_X_GOOG_RESOURCE_STATE") != "sync":
+        logger.info(f"Change notification received for {calendar_obj}")
+        tasks.sync_calendar.delay(calendar_obj.calendar_id)
+
+    return HttpResponse(status=200, content="Notification accepted.")
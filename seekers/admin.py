@@ -1,6 +1,7 @@
 # flake8: noqa
 import copy
 from decimal import Decimal
+import json
 import logging
 
 from django.contrib import admin
@@ -17,7 +18,7 @@ from django.utils.safestring import mark_safe
 from django.utils import timezone
 from django.views.decorators.csrf import csrf_protect
 
-from . import constants, models, mailchimp, tasks
+from . import models, mailchimp, tasks
 from .forms import MassTextForm
 from events.admin import HumanCalendarSubscriptionAdmin
 
@@ -52,16 +53,19 @@ def mass_text(modeladmin, request, queryset):
     if request.POST.get("submitted"):
         form_obj = MassTextForm(request.POST)
         if form_obj.is_valid():
-            for human_obj in queryset:
-                tasks.send_message.delay(
-                    human_obj.pk,
-                    human_obj.contact_preference,
-                    form_obj.cleaned_data.get(
-                        "sms_body" if human_obj.contact_preference == constants.SMS else "email_body"
-                    ),
-                    form_obj.cleaned_data.get("email_subject"),
-                )
+            campaign_obj = models.Campaign.objects.create(
+                source=models.Campaign.HUMANS,
+                selected_ids=json.dumps(list(queryset.values_list("pk", flat=True))),
+                email_subject=form_obj.cleaned_data.get("email_subject"),
+                email_body=form_obj.cleaned_data.get("email_body"),
+                sms_body=form_obj.cleaned_data.get("sms_body"),
+                created_by=request.user,
+            )
+            tasks.queue_campaign.delay(campaign_obj.pk)
             modeladmin.message_user(request, f"Sending email/SMS to {len(queryset)} human(s).", messages.SUCCESS)
+            # Follow the campaign's progress, for those allowed to see it, or go back to the list otherwise
+            if request.user.has_perm("seekers.view_campaign"):
+                return HttpResponseRedirect(reverse("admin:seekers_campaign_change", args=[campaign_obj.pk]))
             return None
     else:
         form_obj = MassTextForm()
@@ -82,22 +86,22 @@ class HumanAdminMixin(object):
     def save_model(self, request, obj, form, change):
         to_return = super().save_model(request, obj, form, change)
         if not change and obj.email:
-            status = mailchimp.client.subscription_status(obj.email)
+            status = models.MailchimpMember.status_for(obj.email)
             if status["status"] != "subscribed":
                 tags = getattr(settings, f"MAILCHIMP_DEFAULT_{self.model._meta.model_name.upper()}_TAGS")
                 logger.info(f"Subscribing new {obj} to mailing list with tags {tags}")
-                mailchimp.client.subscribe_user(obj.first_names, obj.last_names, obj.email, tags)
+                mailchimp.queue_update(obj.email, subscribe=(obj.first_names, obj.last_names), tags=tags)
         return to_return
 
     def save_related(self, request, form, formsets, change):
         to_return = super().save_related(request, form, formsets, change)
         if change and form.instance.email:
-            status = mailchimp.client.subscription_status(form.instance.email)
+            status = models.MailchimpMember.status_for(form.instance.email)
             if status["status"] == "subscribed":
                 mc_form = MailchimpForm(request.POST)
                 if mc_form.is_valid():
                     logger.info(f"Updating subscription tags for {form.instance}")
-                    mailchimp.client.update_user_tags(form.instance.email, mc_form.cleaned_data["tags"])
+                    mailchimp.queue_update(form.instance.email, tags=mc_form.cleaned_data["tags"])
                 else:
                     logger.warning(f"Tags form was invalid. {form.errors}")
         return to_return
@@ -108,7 +112,7 @@ class HumanAdminMixin(object):
         if object_id:
             obj = self.get_object(request, object_id)
             if obj and obj.email:
-                status = mailchimp.client.subscription_status(obj.email)
+                status = models.MailchimpMember.status_for(obj.email)
                 logger.debug(f"Current subscription status: {status}")
                 initial_tags = [tag["name"] for tag in status.get("tags", [])]
                 extra_context["mailchimp_status"] = status
@@ -215,9 +219,11 @@ class HumanAdmin(HumanAdminMixin, admin.ModelAdmin):
     search_fields = ["last_names", "first_names", "email", "phone_number"]
 
     def enroll_as_seeker(self, request, queryset):
+        tag_batch = mailchimp.TagBatch()
         for obj in queryset:
             logger.info(f"Upgrading {obj} from prospect to Seeker.")
-            obj.upgrade_to_seeker()
+            obj.upgrade_to_seeker(tag_batch=tag_batch)
+        tag_batch.submit()
         self.message_user(request, f"{len(queryset)} prospect(s) enrolled as Seekers.")
 
     enroll_as_seeker.short_description = "Enroll as Seeker"
@@ -551,9 +557,54 @@ class CommunityPartnerAdmin(HumanAdminMixin, admin.ModelAdmin):
     list_display = ["first_names", "last_names", "email", "phone_number"]
 
 
+class OutboundMessageAdmin(admin.ModelAdmin):
+    list_display = ["human", "contact_method", "subject", "status", "created", "updated"]
+    list_filter = ["status", "contact_method"]
+    list_select_related = ["human"]
+    date_hierarchy = "created"
+    search_fields = ["provider_id", "human__first_names", "human__last_names"]
+    readonly_fields = ["human", "contact_method", "subject", "provider_id", "status", "error", "created", "updated"]
+
+    def has_add_permission(self, request):
+        return False
+
+
+class CampaignAdmin(admin.ModelAdmin):
+    list_display = ["email_subject", "source", "status", "recipient_count", "created_by", "created"]
+    list_filter = ["source", "status"]
+    list_select_related = ["created_by"]
+    date_hierarchy = "created"
+    fields = [
+        ("source", "status"),
+        ("created_by", "created"),
+        "email_subject",
+        "email_body",
+        "sms_body",
+        "progress",
+    ]
+    readonly_fields = ["progress"]
+
+    def progress(self, obj):
+        counts = obj.delivery_counts()
+        return (
+            f"{obj.recipient_count} recipient(s) queued, {sum(counts.values())} message(s) sent: "
+            f"{counts[models.OutboundMessage.DELIVERED]} delivered, "
+            f"{counts[models.OutboundMessage.SENT]} awaiting a delivery report, "
+            f"{counts[models.OutboundMessage.UNDELIVERED]} undelivered, {counts[models.OutboundMessage.FAILED]} failed"
+        )
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+
 admin.site.register(models.Human, HumanAdmin)
 admin.site.register(models.Seeker, SeekerAdmin)
 admin.site.register(models.CommunityPartner, CommunityPartnerAdmin)
 admin.site.register(models.SeekerPairing, SeekerPairingAdmin)
 admin.site.register(models.SeekerBenefitProxy, SeekerBenefitProxyAdmin)
 admin.site.register(models.SeekerBenefitType, SeekerBenefitTypeAdmin)
+admin.site.register(models.Campaign, CampaignAdmin)
+admin.site.register(models.OutboundMessage, OutboundMessageAdmin)
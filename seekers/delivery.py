@@ -0,0 +1,80 @@
+"""Delivery statuses reported by Twilio and Mailgun are collected in Redis as they come in, and written to
+their OutboundMessages in batches by the flush_message_statuses task."""
+
+import json
+import logging
+import time
+
+from django.utils.timezone import now
+import redis
+
+from athene.redis_client import client
+from .models import OutboundMessage
+
+logger = logging.getLogger(__name__)
+
+STATUS_KEY = "outbound:statuses"
+
+# Statuses for messages that still haven't been recorded after this many seconds are dropped
+PENDING_MAX_AGE = 60 * 60
+
+# Only replaces a message's pending status with one that comes later in its life
+RECORD_SCRIPT = client.register_script(
+    """
+    local current = redis.call("HGET", KEYS[1], ARGV[1])
+    if current and tonumber(cjson.decode(current)["order"]) > tonumber(ARGV[3]) then
+        return 0
+    end
+    redis.call("HSET", KEYS[1], ARGV[1], ARGV[2])
+    return 1
+    """
+)
+
+
+def record_status(provider_id, status, error=""):
+    order = OutboundMessage.STATUS_ORDER[status]
+    report = dict(status=status, error=error[:255], order=order, reported=time.time())
+    try:
+        RECORD_SCRIPT(keys=[STATUS_KEY], args=[provider_id, json.dumps(report), order])
+    except redis.RedisError:
+        logger.exception(f"Could not reach Redis, recording the status of {provider_id} directly")
+        apply_statuses({provider_id: report})
+
+
+def apply_statuses(reports):
+    """Writes the reported statuses to their messages, returning the reports for messages that aren't in the
+    database yet."""
+    reports = dict(reports)
+    changed = []
+    for message_obj in OutboundMessage.objects.filter(provider_id__in=list(reports)):
+        report = reports.pop(message_obj.provider_id)
+        if report["order"] < OutboundMessage.STATUS_ORDER[message_obj.status]:
+            continue
+        if (report["status"], report["error"]) != (message_obj.status, message_obj.error):
+            message_obj.status, message_obj.error, message_obj.updated = report["status"], report["error"], now()
+            changed.append(message_obj)
+    OutboundMessage.objects.bulk_update(changed, ["status", "error", "updated"], batch_size=500)
+    return reports
+
+
+def flush_statuses():
+    pipeline = client.pipeline()
+    pipeline.hgetall(STATUS_KEY)
+    pipeline.delete(STATUS_KEY)
+    reports, _ = pipeline.execute()
+    reports = {provider_id.decode(): json.loads(report) for provider_id, report in reports.items()}
+    pending = apply_statuses(reports)
+    # The message may only just have been sent, so its record could still be on its way
+    requeue = {
+        provider_id: report
+        for provider_id, report in pending.items()
+        if report["reported"] > time.time() - PENDING_MAX_AGE
+    }
+    if requeue:
+        pipeline = client.pipeline()
+        for provider_id, report in requeue.items():
+            pipeline.hsetnx(STATUS_KEY, provider_id, json.dumps(report))
+        pipeline.execute()
+    if len(pending) > len(requeue):
+        logger.warning(f"Dropped {len(pending) - len(requeue)} status(es) for messages that were never recorded")
+    return len(reports) - len(pending)
@@ -1,13 +1,55 @@
+import io
+import json
 import logging
 import hashlib
+import tarfile
 
 from django.conf import settings
 import mailchimp3
 from mailchimp3.mailchimpclient import MailChimpError
+import requests
+
+from athene import redis_client
 
 
 logger = logging.getLogger(__name__)
 
+# How many list members are fetched at a time, and the fields fetched for each
+MEMBERS_PAGE_SIZE = 1000
+MEMBER_FIELDS = "email_address,status,unsubscribe_reason,tags.name,last_changed"
+
+# Seconds to wait for further changes to someone's subscription before sending them to Mailchimp
+UPDATE_DEBOUNCE = 10
+# Queued changes are kept this long, so they survive the task being held up by a backlog or a worker restart
+UPDATE_EXPIRY = 60 * 60 * 24
+
+# Events from Mailchimp's webhook are held here, and those arriving within this many seconds of the first are
+# written to our copy of the list together
+WEBHOOK_EVENTS_KEY = "mailchimp:webhook-events"
+WEBHOOK_FLUSH_DELAY = 30
+
+
+def subscriber_hash(email):
+    return hashlib.md5(email.lower().encode("utf8")).hexdigest()
+
+
+def tag_map(tags):
+    """Returns the tag changes that leave exactly ``tags`` active, out of the tags we manage."""
+    return [{"name": tag, "status": "active" if tag in tags else "inactive"} for tag in settings.MAILCHIMP_TAGS]
+
+
+def apply_tag_map(current_tags, tags):
+    """Returns someone's tags after updating them to ``tags``, keeping any tags we don't manage."""
+    return sorted(
+        set(current_tags).difference(settings.MAILCHIMP_TAGS).union(set(tags) & set(settings.MAILCHIMP_TAGS))
+    )
+
+
+def error_status(e):
+    """Returns the HTTP status of a MailChimpError, taking anything without one to be a server error."""
+    error = e.args[0] if e.args and isinstance(e.args[0], dict) else {}
+    return int(error.get("status", 500))
+
 
 class MailChimp(object):
     def __init__(self):
@@ -18,21 +60,42 @@ class MailChimp(object):
         self.list_id = settings.MAILCHIMP_LIST_ID
 
     def subscription_status(self, email):
+        """Returns someone's subscription status, or never-subscribed if they aren't on the list. Any other error
+        from Mailchimp is raised, rather than being taken to mean they aren't."""
         if not self.client:
             return {"status": "mailchip-unconfigured"}
-        subscriber_hash = hashlib.md5(email.lower().encode("utf8")).hexdigest()
         try:
             status = self.client.lists.members.get(
                 list_id=self.list_id,
-                subscriber_hash=subscriber_hash,
+                subscriber_hash=subscriber_hash(email),
                 fields="id,email_address,status,unsubscribe_reason,merge_fields,tags",
             )
-        except MailChimpError:
+        except MailChimpError as e:
+            if error_status(e) != 404:
+                raise
             return {"status": "never-subscribed"}
         else:
             return status
 
-    def subscribe_user(self, first_names, last_names, email, tags):
+    def iter_members(self, since_last_changed=None, page_size=MEMBERS_PAGE_SIZE):
+        """Yields pages of list members, optionally only those changed since the given datetime."""
+        params = dict(
+            fields=",".join(["total_items"] + [f"members.{field}" for field in MEMBER_FIELDS.split(",")]),
+            count=page_size,
+        )
+        if since_last_changed:
+            params["since_last_changed"] = since_last_changed.isoformat()
+        offset = 0
+        while True:
+            page = self.client.lists.members.all(list_id=self.list_id, offset=offset, **params)
+            if not page["members"]:
+                return
+            yield page["members"]
+            offset += len(page["members"])
+            if offset >= page["total_items"]:
+                return
+
+    def subscribe_user(self, first_names, last_names, email, tags, fail_silently=True):
         if not self.client:
             logger.warning("Mailchimp is not properly configured.")
         else:
@@ -48,23 +111,146 @@ class MailChimp(object):
                 )
             except MailChimpError:
                 logger.exception(f"Error subscribing user {email} to list.")
-        return self.subscription_status(email)
+                if not fail_silently:
+                    raise
+        return self.refresh_member(email)
 
-    def update_user_tags(self, email, tags):
+    def update_user_tags(self, email, tags, fail_silently=True):
         if not self.client:
             logger.warning("Mailchimp is not properly configured.")
         else:
-            subscriber_hash = hashlib.md5(email.lower().encode("utf8")).hexdigest()
-            tag_map = [
-                {"name": tag, "status": "active" if tag in tags else "inactive"} for tag in settings.MAILCHIMP_TAGS
-            ]
             try:
                 self.client.lists.members.tags.update(
-                    list_id=self.list_id, subscriber_hash=subscriber_hash, data=dict(tags=tag_map)
+                    list_id=self.list_id, subscriber_hash=subscriber_hash(email), data=dict(tags=tag_map(tags))
                 )
             except MailChimpError:
                 logger.exception(f"Error updating user tags for {email}.")
-        return self.subscription_status(email)
+                if not fail_silently:
+                    raise
+        return self.refresh_member(email)
+
+    def refresh_member(self, email):
+        """Fetches someone's subscription status, and saves it to our copy of the list. If Mailchimp can't say
+        what it is, our copy is left alone and this returns None."""
+        from .models import MailchimpMember
+
+        try:
+            status = self.subscription_status(email)
+        except (MailChimpError, requests.RequestException):
+            logger.exception(f"Error fetching the subscription status of {email}.")
+            return None
+        if self.client:
+            MailchimpMember.store(email, status)
+        return status
+
+    def submit_tag_batch(self, changes):
+        """Submits tag updates for several people as a single batch operation, given a dict of subscriber hash
+        to the tags they should have. Returns the batch's ID."""
+        operations = [
+            dict(
+                method="POST",
+                path=f"/lists/{self.list_id}/members/{member_hash}/tags",
+                operation_id=member_hash,
+                body=json.dumps(dict(tags=tag_map(tags))),
+            )
+            for member_hash, tags in changes.items()
+        ]
+        return self.client.batches.create(data=dict(operations=operations))["id"]
+
+    def batch_status(self, batch_id):
+        return self.client.batches.get(
+            batch_id=batch_id, fields="id,status,total_operations,errored_operations,response_body_url"
+        )
+
+    def batch_results(self, response_body_url):
+        """Downloads a finished batch's results, returning each operation's result."""
+        response = requests.get(response_body_url, timeout=30)
+        response.raise_for_status()
+        results = []
+        with tarfile.open(fileobj=io.BytesIO(response.content), mode="r:gz") as archive:
+            for member in archive.getmembers():
+                if member.isfile() and member.name.endswith(".json"):
+                    results += json.load(archive.extractfile(member))
+        return results
+
+
+def pending_updates(email):
+    return redis_client.Debouncer(
+        f"mailchimp:updates:{subscriber_hash(email)}", UPDATE_DEBOUNCE, merge=True, expiry=UPDATE_EXPIRY
+    )
+
+
+def queue_update(email, **update):
+    """Queues a change to someone's subscription, either ``subscribe`` with their names or ``tags``. Changes
+    made within UPDATE_DEBOUNCE seconds of each other are merged, with the latest tags winning, and sent to
+    Mailchimp together by the apply_mailchimp_update task."""
+    from .tasks import apply_mailchimp_update
+
+    if not client.client:
+        return
+    pending_updates(email).add(
+        update,
+        schedule=lambda delay: apply_mailchimp_update.apply_async((email,), countdown=delay),
+        handle_now=lambda: apply_mailchimp_update.delay(email, update),
+    )
+
+
+def take_update(email):
+    """Returns the changes queued for someone's subscription, and clears them."""
+    return pending_updates(email).drain()
+
+
+def requeue_update(email, update):
+    """Puts back changes that couldn't be sent to Mailchimp, without overwriting any queued since. Returns whether
+    a retry needs scheduling, because no run is already due to send them."""
+    return pending_updates(email).restore(update)
+
+
+webhook_events = redis_client.Debouncer(WEBHOOK_EVENTS_KEY, WEBHOOK_FLUSH_DELAY)
+
+
+def record_webhook_event(event):
+    """Holds an event from Mailchimp's webhook until the flush_mailchimp_events task applies it."""
+    from .tasks import flush_mailchimp_events
+
+    webhook_events.add(
+        event,
+        schedule=lambda delay: flush_mailchimp_events.apply_async(countdown=delay),
+        handle_now=lambda: flush_mailchimp_events.delay([event]),
+    )
+
+
+def take_webhook_events():
+    """Returns the events held from Mailchimp's webhook in the order they arrived, and clears them."""
+    return webhook_events.drain()
+
+
+class TagBatch(object):
+    """Collects tag updates for several people to send to Mailchimp together as one batch operation, which
+    poll_mailchimp_batches then applies to our copy of the list once Mailchimp has finished with it."""
+
+    def __init__(self):
+        self.changes = {}
+
+    def set_tags(self, email, tags):
+        self.changes[subscriber_hash(email)] = dict(email=email, tags=sorted(tags))
+
+    def submit(self):
+        from .models import MailchimpBatch
+
+        if not self.changes:
+            return None
+        if not client.client:
+            logger.warning("Mailchimp is not properly configured.")
+            return None
+        try:
+            batch_id = client.submit_tag_batch(
+                {member_hash: change["tags"] for member_hash, change in self.changes.items()}
+            )
+        except MailChimpError:
+            logger.exception(f"Error submitting tag updates for {len(self.changes)} user(s).")
+            return None
+        return MailchimpBatch.objects.create(batch_id=batch_id, changes=json.dumps(self.changes))
 
 
 client = MailChimp()
@@ -0,0 +1,116 @@
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import threading
+import time
+from urllib.parse import parse_qs
+import uuid
+
+from django.conf import settings
+from django.core.management import BaseCommand
+import requests
+
+from seekers import twilio
+
+logger = logging.getLogger(__name__)
+
+
+class FakeTwilio(ThreadingHTTPServer):
+    """Accepts messages like Twilio's API does, answering 429 when they come in faster than ``mps`` a second."""
+
+    daemon_threads = True
+
+    def __init__(self, address, mps, latency):
+        super().__init__(address, FakeTwilioHandler)
+        self.mps = mps
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.tokens = mps
+        self.refilled = time.monotonic()
+        self.accepted = self.rejected = 0
+
+    def admit(self):
+        with self.lock:
+            current = time.monotonic()
+            self.tokens = min(self.mps, self.tokens + (current - self.refilled) * self.mps)
+            self.refilled = current
+            if self.tokens >= 1:
+                self.tokens -= 1
+                self.accepted += 1
+                return True
+            self.rejected += 1
+            return False
+
+
+class FakeTwilioHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        data = parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode())
+        if not self.path.endswith("/Messages.json"):
+            self.respond(404, dict(message="Not found"))
+        elif not self.server.admit():
+            self.respond(429, dict(code=20429, message="Too Many Requests"), {"Retry-After": "1"})
+        else:
+            time.sleep(self.server.latency)
+            self.respond(
+                201, dict(sid=f"SM{uuid.uuid4().hex}", status="queued", to=data.get("To", [""])[0]),
+            )
+
+    def respond(self, status, body, headers=None):
+        content = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+class Command(BaseCommand):
+    help = "Run a local stand-in for Twilio's messages API, or benchmark sending texts through it"
+
+    def add_arguments(self, parser):
+        parser.add_argument("--port", action="store", type=int, default=8099)
+        parser.add_argument(
+            "--mps", action="store", type=float, default=10.0, help="Messages per second to accept before a 429."
+        )
+        parser.add_argument(
+            "--latency", action="store", type=float, default=0.05, help="Seconds to take accepting each message."
+        )
+        parser.add_argument("--bench", action="store", type=int, help="Send this many texts through it and exit.")
+        parser.add_argument("--concurrency", action="store", type=int, default=8)
+
+    def handle(self, *args, **options):
+        server = FakeTwilio(("127.0.0.1", options["port"]), options["mps"], options["latency"])
+        if not options["bench"]:
+            logger.info(f"Twilio stand-in listening on http://127.0.0.1:{options['port']}")
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            return
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        sms = twilio.SMS()
+        sms.username = "ACfake"
+        sms.auth = requests.auth.HTTPBasicAuth(username=sms.username, password="fake")
+        sms.my_phone_number = "+15555550100"
+        sms.api_base = f"http://127.0.0.1:{options['port']}"
+        sms.dry_run = False
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as executor:
+            list(
+                executor.map(lambda i: sms.send_text(f"+1555555{i:04d}", "Benchmark message"), range(options["bench"]))
+            )
+        elapsed = time.monotonic() - started
+        server.shutdown()
+        logger.info(
+            f"Sent {server.accepted} of {options['bench']} text(s) in {elapsed:.2f}s "
+            f"({server.accepted / elapsed:.1f}/s, limited to {settings.TWILIO_RATE_LIMIT}/s); "
+            f"{server.rejected} were turned away with a 429."
+        )
@@ -0,0 +1,60 @@
+import logging
+
+from django.conf import settings
+from django.core.management import BaseCommand, CommandError
+from django.test import Client
+from django.utils.timezone import now
+import requests
+
+from seekers import tasks, views
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = "Stand in for Mailchimp and send subscription events to the webhook"
+
+    def add_arguments(self, parser):
+        parser.add_argument("type", choices=["subscribe", "unsubscribe", "profile", "upemail", "cleaned"])
+        parser.add_argument("emails", nargs="+", metavar="email")
+        parser.add_argument("--new-email", action="store", help="The address an upemail event changes to.")
+        parser.add_argument("--action", action="store", default="unsub", choices=["unsub", "delete"])
+        parser.add_argument("--reason", action="store", help="Defaults to manual for unsubscribes, hard for cleaned.")
+        parser.add_argument(
+            "--url", action="store", help="Post to a running server at this URL instead of handling it in-process."
+        )
+        parser.add_argument(
+            "--flush", action="store_true", help="Apply the events straight away rather than waiting for the task."
+        )
+
+    def handle(self, *args, **options):
+        if not views.MAILCHIMP_WEBHOOK_KEY:
+            raise CommandError("MAILCHIMP_WEBHOOK_KEY is not set.")
+        if options["type"] == "upemail" and not options["new_email"]:
+            raise CommandError("An upemail event needs --new-email.")
+        client = Client(HTTP_HOST="127.0.0.1")
+        for email in options["emails"]:
+            data = {
+                "type": options["type"],
+                "fired_at": now().strftime("%Y-%m-%d %H:%M:%S"),
+                "data[list_id]": settings.MAILCHIMP_LIST_ID or "",
+            }
+            if options["type"] == "upemail":
+                data.update({"data[old_email]": email, "data[new_email]": options["new_email"]})
+            else:
+                data["data[email]"] = email
+            if options["type"] == "unsubscribe":
+                data.update({"data[action]": options["action"], "data[reason]": options["reason"] or "manual"})
+            elif options["type"] == "cleaned":
+                data["data[reason]"] = options["reason"] or "hard"
+            if options["url"]:
+                response = requests.post(
+                    options["url"], params=dict(key=views.MAILCHIMP_WEBHOOK_KEY), data=data, timeout=10
+                )
+                status_code, content = response.status_code, response.text
+            else:
+                response = client.post(f"/webhooks/mailchimp/?key={views.MAILCHIMP_WEBHOOK_KEY}", data)
+                status_code, content = response.status_code, response.content.decode()
+            logger.info(f"Webhook responded for {email} ({status_code}) {content}")
+        if options["flush"]:
+            tasks.flush_mailchimp_events()
@@ -0,0 +1,41 @@
+# Generated by Django 2.2.14 on 2026-10-18 02:38
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("seekers", "0019_auto_20200708_2317"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="OutboundMessage",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("contact_method", models.IntegerField(choices=[(1, "Email"), (2, "SMS")])),
+                ("subject", models.CharField(blank=True, max_length=255)),
+                ("provider_id", models.CharField(blank=True, db_index=True, max_length=255)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("sent", "Sent"),
+                            ("delivered", "Delivered"),
+                            ("undelivered", "Undelivered"),
+                            ("failed", "Failed"),
+                        ],
+                        default="sent",
+                        max_length=20,
+                    ),
+                ),
+                ("error", models.CharField(blank=True, max_length=255)),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("updated", models.DateTimeField(auto_now=True)),
+                ("human", models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to="seekers.Human")),
+            ],
+            options={"ordering": ("-created",),},
+        ),
+    ]
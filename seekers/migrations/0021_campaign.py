@@ -0,0 +1,59 @@
+# Generated by Django 2.2.14 on 2026-10-18 02:42
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("seekers", "0020_outboundmessage"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="Campaign",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                (
+                    "source",
+                    models.CharField(
+                        choices=[("humans", "Selected people"), ("calendars", "Calendar subscribers")], max_length=20
+                    ),
+                ),
+                ("selected_ids", models.TextField(editable=False)),
+                ("email_subject", models.CharField(max_length=255)),
+                ("email_body", models.TextField()),
+                ("sms_body", models.TextField()),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[("pending", "Pending"), ("queueing", "Queueing"), ("queued", "Queued")],
+                        default="pending",
+                        max_length=20,
+                    ),
+                ),
+                ("recipient_count", models.PositiveIntegerField(default=0)),
+                ("created", models.DateTimeField(auto_now_add=True)),
+                ("updated", models.DateTimeField(auto_now=True)),
+                (
+                    "created_by",
+                    models.ForeignKey(
+                        editable=False,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name="outboundmessage",
+            name="campaign",
+            field=models.ForeignKey(
+                blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to="seekers.Campaign"
+            ),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.14 on 2026-10-18 02:43
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("seekers", "0021_campaign"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MailchimpMember",
+            fields=[
+                ("subscriber_hash", models.CharField(max_length=32, primary_key=True, serialize=False)),
+                ("email", models.EmailField(max_length=254)),
+                ("status", models.CharField(max_length=20)),
+                ("unsubscribe_reason", models.CharField(blank=True, max_length=255)),
+                ("tags", models.TextField(default="[]")),
+                ("fetched", models.DateTimeField(auto_now=True)),
+                (
+                    "human",
+                    models.ForeignKey(
+                        blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to="seekers.Human"
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.14 on 2026-10-18 02:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("seekers", "0022_mailchimpmember"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="mailchimpmember",
+            name="last_changed",
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 2.2.14 on 2026-10-18 02:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("seekers", "0023_mailchimpmember_last_changed"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="MailchimpBatch",
+            fields=[
+                ("id", models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("batch_id", models.CharField(max_length=32, unique=True)),
+                ("changes", models.TextField()),
+                ("status", models.CharField(default="pending", max_length=20)),
+                ("errored_operations", models.PositiveIntegerField(default=0)),
+                ("submitted", models.DateTimeField(auto_now_add=True)),
+                ("completed", models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+    ]
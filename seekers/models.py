@@ -1,12 +1,16 @@
+import datetime
+import json
 import logging
 import random
 import string
 from django.conf import settings
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Q
+from django.db.models.functions import Lower
 from django import template
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from ckeditor.fields import RichTextField
 import googlemaps
@@ -65,7 +69,9 @@ class Human(models.Model):
     def __str__(self):
         return f"{self.first_names} {self.last_names}"
 
-    def upgrade_to_seeker(self):
+    def upgrade_to_seeker(self, tag_batch=None):
+        """Enrolls this person as a Seeker, adding the default Seeker tags to their mailing list subscription.
+        Given a mailchimp.TagBatch, the tags are added to it rather than queued on their own."""
         seeker = Seeker(
             human_ptr=self,
             enroll_date=timezone.now().date(),
@@ -73,13 +79,15 @@ class Human(models.Model):
         )
         seeker.save()
         if self.email:
-            status = mailchimp.client.subscription_status(self.email)
+            status = MailchimpMember.status_for(self.email)
             if status["status"] == "subscribed":
                 logger.info("Adding default Seeker tags to mailing list subscription.")
                 current_tags = [tag["name"] for tag in status["tags"]]
-                mailchimp.client.update_user_tags(
-                    self.email, list(set(current_tags).union(set(settings.MAILCHIMP_DEFAULT_SEEKER_TAGS)))
-                )
+                tags = list(set(current_tags).union(set(settings.MAILCHIMP_DEFAULT_SEEKER_TAGS)))
+                if tag_batch is not None:
+                    tag_batch.set_tags(self.email, tags)
+                else:
+                    mailchimp.queue_update(self.email, tags=tags)
         return seeker
 
     def mark_as_community_partner(self):
@@ -318,3 +326,280 @@ class SeekerBenefitProxy(Seeker):
 
 class CommunityPartner(Human):
     organization = models.CharField(max_length=120, blank=True)
+
+
+class MailchimpMember(models.Model):
+    """Our copy of someone's subscription to the Mailchimp list, so it can be shown without asking Mailchimp.
+    It's kept up to date by Mailchimp's webhook, the sync_mailchimp_list task and whenever we change the
+    subscription. People who aren't on the list get one too, with a status of never-subscribed."""
+
+    NEVER_SUBSCRIBED = "never-subscribed"
+    # The status each of the webhook's events leaves someone with
+    WEBHOOK_STATUSES = dict(subscribe="subscribed", unsubscribe="unsubscribed", cleaned="cleaned")
+
+    subscriber_hash = models.CharField(max_length=32, primary_key=True)
+    email = models.EmailField()
+    human = models.ForeignKey(Human, on_delete=models.SET_NULL, blank=True, null=True)
+    status = models.CharField(max_length=20)
+    unsubscribe_reason = models.CharField(max_length=255, blank=True)
+    # JSON list of tag names
+    tags = models.TextField(default="[]")
+    # When Mailchimp last saw a change, as of the last list sync
+    last_changed = models.DateTimeField(blank=True, null=True, editable=False)
+    fetched = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.email} ({self.status})"
+
+    @property
+    def tag_names(self):
+        return json.loads(self.tags)
+
+    def as_status(self):
+        """Returns the subscription in the same shape as Mailchimp's member data."""
+        return dict(
+            email_address=self.email,
+            status=self.status,
+            unsubscribe_reason=self.unsubscribe_reason,
+            tags=[dict(name=tag) for tag in self.tag_names],
+        )
+
+    @classmethod
+    def store(cls, email, status):
+        """Saves someone's subscription status, as fetched from Mailchimp."""
+        member_obj, _ = cls.objects.update_or_create(
+            subscriber_hash=mailchimp.subscriber_hash(email),
+            defaults=dict(
+                email=status.get("email_address", email),
+                human=Human.objects.filter(email__iexact=email).first(),
+                status=status["status"],
+                unsubscribe_reason=status.get("unsubscribe_reason") or "",
+                tags=json.dumps([tag["name"] for tag in status.get("tags", [])]),
+            ),
+        )
+        return member_obj
+
+    @classmethod
+    def store_list_members(cls, members):
+        """Saves a page of members from the list, matching them to people by email address."""
+        members = {mailchimp.subscriber_hash(member["email_address"]): member for member in members}
+        humans = dict(
+            Human.objects.annotate(email_lower=Lower("email"))
+            .filter(email_lower__in=[member["email_address"].lower() for member in members.values()])
+            .values_list("email_lower", "pk")
+        )
+        existing = cls.objects.in_bulk(list(members))
+        to_create = []
+        for subscriber_hash, member in members.items():
+            member_obj = existing.get(subscriber_hash) or cls(subscriber_hash=subscriber_hash)
+            member_obj.email = member["email_address"]
+            member_obj.human_id = humans.get(member["email_address"].lower())
+            member_obj.status = member["status"]
+            member_obj.unsubscribe_reason = member.get("unsubscribe_reason") or ""
+            member_obj.tags = json.dumps([tag["name"] for tag in member.get("tags", [])])
+            member_obj.last_changed = parse_datetime(member["last_changed"]) if member.get("last_changed") else None
+            member_obj.fetched = timezone.now()
+            if subscriber_hash not in existing:
+                to_create.append(member_obj)
+        cls.objects.bulk_create(to_create)
+        cls.objects.bulk_update(
+            existing.values(),
+            ["email", "human", "status", "unsubscribe_reason", "tags", "last_changed", "fetched"],
+            batch_size=500,
+        )
+        return len(to_create), len(existing)
+
+    @classmethod
+    def apply_webhook_events(cls, events):
+        """Applies the subscribe, unsubscribe and cleaned events from Mailchimp's webhook, with the latest
+        event for each person winning. The webhook doesn't say what someone's tags are, or what changed in
+        their profile, so this returns the email addresses of anyone whose subscription should be fetched
+        again."""
+        changes, removed, refresh = {}, set(), set()
+        for event in events:
+            member_hash = mailchimp.subscriber_hash(event["email"])
+            if event["type"] in cls.WEBHOOK_STATUSES:
+                changes[member_hash] = event
+                removed.discard(member_hash)
+            elif event["type"] == "upemail":
+                # They're on the list under their new address now
+                changes.pop(member_hash, None)
+                removed.add(member_hash)
+                refresh.add(event["new_email"])
+            else:
+                refresh.add(event["email"])
+
+        humans = dict(
+            Human.objects.annotate(email_lower=Lower("email"))
+            .filter(email_lower__in=[event["email"].lower() for event in changes.values()])
+            .values_list("email_lower", "pk")
+        )
+        existing = cls.objects.in_bulk(list(changes))
+        to_create = []
+        for member_hash, event in changes.items():
+            member_obj = existing.get(member_hash) or cls(subscriber_hash=member_hash)
+            member_obj.email = event["email"]
+            member_obj.human_id = humans.get(event["email"].lower())
+            if event["type"] == "unsubscribe" and event.get("action") == "delete":
+                member_obj.status = "archived"
+            else:
+                member_obj.status = cls.WEBHOOK_STATUSES[event["type"]]
+            member_obj.unsubscribe_reason = event.get("reason", "") if event["type"] == "unsubscribe" else ""
+            member_obj.fetched = timezone.now()
+            if member_hash not in existing:
+                to_create.append(member_obj)
+                refresh.add(event["email"])
+        with transaction.atomic():
+            cls.objects.bulk_create(to_create)
+            cls.objects.bulk_update(
+                existing.values(), ["email", "human", "status", "unsubscribe_reason", "fetched"], batch_size=500
+            )
+            cls.objects.filter(pk__in=removed).delete()
+        return refresh
+
+    @classmethod
+    def status_for(cls, email):
+        """Returns our copy of someone's subscription status, in the same shape as Mailchimp's member data."""
+        if not mailchimp.client.client:
+            return {"status": "mailchip-unconfigured"}
+        try:
+            return cls.objects.get(subscriber_hash=mailchimp.subscriber_hash(email)).as_status()
+        except cls.DoesNotExist:
+            from .tasks import refresh_mailchimp_member
+
+            # We haven't looked them up yet, so do so in the background for next time
+            refresh_mailchimp_member.delay(email)
+            return {"status": cls.NEVER_SUBSCRIBED}
+
+
+class MailchimpBatch(models.Model):
+    """Tag updates submitted to Mailchimp as a batch operation, to be applied to our copy of the list once
+    Mailchimp has finished with them."""
+
+    FINISHED = "finished"
+
+    batch_id = models.CharField(max_length=32, unique=True)
+    # JSON dict of subscriber hash to the email address and tags sent
+    changes = models.TextField()
+    status = models.CharField(max_length=20, default="pending")
+    errored_operations = models.PositiveIntegerField(default=0)
+    submitted = models.DateTimeField(auto_now_add=True)
+    completed = models.DateTimeField(blank=True, null=True)
+
+    def __str__(self):
+        return f"Mailchimp batch {self.batch_id} ({self.status})"
+
+    def apply_results(self, results):
+        """Applies the tag updates that succeeded to our copy of the list, and returns the email addresses of
+        those that didn't."""
+        changes = json.loads(self.changes)
+        succeeded = {result["operation_id"] for result in results if result["status_code"] < 300}
+        members = MailchimpMember.objects.in_bulk([member_hash for member_hash in changes if member_hash in succeeded])
+        for member_hash, member_obj in members.items():
+            member_obj.tags = json.dumps(mailchimp.apply_tag_map(member_obj.tag_names, changes[member_hash]["tags"]))
+            member_obj.fetched = timezone.now()
+        MailchimpMember.objects.bulk_update(members.values(), ["tags", "fetched"], batch_size=500)
+        return [change["email"] for member_hash, change in changes.items() if member_hash not in succeeded]
+
+
+class Campaign(models.Model):
+    """A mass communication, sent to the people selected or to everyone subscribed to the calendars selected."""
+
+    HUMANS = "humans"
+    CALENDARS = "calendars"
+    SOURCES = [(HUMANS, "Selected people"), (CALENDARS, "Calendar subscribers")]
+
+    PENDING = "pending"
+    QUEUEING = "queueing"
+    QUEUED = "queued"
+    STATUSES = [(PENDING, "Pending"), (QUEUEING, "Queueing"), (QUEUED, "Queued")]
+
+    # The progress page stops refreshing itself once a campaign is this old
+    PROGRESS_MAX_AGE = datetime.timedelta(days=1)
+
+    source = models.CharField(max_length=20, choices=SOURCES)
+    # JSON list of the primary keys of the people or calendars selected
+    selected_ids = models.TextField(editable=False)
+    email_subject = models.CharField(max_length=255)
+    email_body = models.TextField()
+    sms_body = models.TextField()
+    status = models.CharField(max_length=20, choices=STATUSES, default=PENDING)
+    recipient_count = models.PositiveIntegerField(default=0)
+    created_by = models.ForeignKey("auth.User", on_delete=models.SET_NULL, editable=False, null=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.email_subject} ({self.created:%Y-%m-%d})"
+
+    def recipients(self, chunk_size):
+        """Yields lists of (human ID, contact method) for everyone the campaign goes to, paging through them
+        by key rather than offset. People selected directly get their own contact preference."""
+        selected_ids = json.loads(self.selected_ids)
+        if self.source == self.HUMANS:
+            last_id = None
+            while True:
+                page = Human.objects.filter(pk__in=selected_ids).order_by("pk")
+                if last_id is not None:
+                    page = page.filter(pk__gt=last_id)
+                page = list(page.values_list("pk", "contact_preference")[:chunk_size])
+                if not page:
+                    return
+                yield page
+                last_id = page[-1][0]
+        else:
+            from events.models import HumanCalendarSubscription
+
+            last = None
+            while True:
+                page = (
+                    HumanCalendarSubscription.objects.filter(calendar__in=selected_ids)
+                    .values_list("human_id", "contact_method")
+                    .distinct()
+                    .order_by("human_id", "contact_method")
+                )
+                if last is not None:
+                    page = page.filter(Q(human_id__gt=last[0]) | Q(human_id=last[0], contact_method__gt=last[1]))
+                page = list(page[:chunk_size])
+                if not page:
+                    return
+                yield page
+                last = page[-1]
+
+    def delivery_counts(self):
+        counts = dict.fromkeys(dict(OutboundMessage.STATUSES), 0)
+        counts.update(self.outboundmessage_set.values_list("status").annotate(count=models.Count("pk")).order_by())
+        return counts
+
+    @property
+    def in_progress(self):
+        if timezone.now() - self.created > self.PROGRESS_MAX_AGE:
+            return False
+        return self.status != self.QUEUED or self.outboundmessage_set.filter(status=OutboundMessage.SENT).exists()
+
+
+class OutboundMessage(models.Model):
+    SENT = "sent"
+    DELIVERED = "delivered"
+    UNDELIVERED = "undelivered"
+    FAILED = "failed"
+    STATUSES = [(SENT, "Sent"), (DELIVERED, "Delivered"), (UNDELIVERED, "Undelivered"), (FAILED, "Failed")]
+    # Reports can arrive out of order, so a status never replaces one that comes later in a message's life
+    STATUS_ORDER = {SENT: 0, DELIVERED: 1, UNDELIVERED: 1, FAILED: 1}
+
+    human = models.ForeignKey(Human, on_delete=models.CASCADE)
+    campaign = models.ForeignKey(Campaign, on_delete=models.SET_NULL, blank=True, null=True)
+    contact_method = models.IntegerField(choices=CONTACT_PREFERENCES)
+    subject = models.CharField(max_length=255, blank=True)
+    # The Twilio message SID or email Message-ID
+    provider_id = models.CharField(max_length=255, blank=True, db_index=True)
+    status = models.CharField(max_length=20, choices=STATUSES, default=SENT)
+    error = models.CharField(max_length=255, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.get_contact_method_display()} to {self.human} ({self.status})"
+
+    class Meta:
+        ordering = ("-created",)
@@ -4,12 +4,16 @@ import os
 
 from django.conf import settings
 
+from athene.redis_client import Debouncer
 from . import tasks
 
 logger = logging.getLogger(__name__)
 
 WEBHOOK_MAP = json.loads(os.environ.get("SLACK_WEBHOOK_MAP", "{}"))
 
+# Slack won't take a message with more blocks than this
+MAX_BLOCKS = 50
+
 
 def send_message_to_channel(channel, basic_text, blocks, sync=False):
     logger.info(f"Sending message to {channel}: {basic_text}")
@@ -21,6 +25,43 @@ def send_message_to_channel(channel, basic_text, blocks, sync=False):
         )
 
 
+def forwards(channel):
+    return Debouncer(f"slack:forwards:{channel}", settings.SLACK_COALESCE_SECONDS, leading=True)
+
+
+def forward_message(channel, basic_text, greeting, message_block):
+    """Posts a message we received to a channel. The first message goes straight out, and any others that
+    arrive for the same channel within SLACK_COALESCE_SECONDS of it are held back and posted together by
+    flush_forwarded_messages."""
+    blocks = [dict(type="section", text=dict(type="mrkdwn", text=greeting)), dict(type="divider"), message_block]
+    if not settings.SLACK_COALESCE_SECONDS:
+        send_message_to_channel(channel, basic_text, blocks)
+        return
+    forwards(channel).add(
+        dict(text=basic_text, blocks=blocks),
+        schedule=lambda delay: tasks.flush_forwarded_messages.apply_async((channel,), countdown=delay),
+        handle_now=lambda: send_message_to_channel(channel, basic_text, blocks),
+    )
+
+
+def flush_forwarded_messages(channel):
+    messages = forwards(channel).drain()
+    if len(messages) == 1:
+        send_message_to_channel(channel, messages[0]["text"], messages[0]["blocks"])
+        return
+    # Several messages are posted as a header followed by each message's own block, split across posts as needed
+    per_post = (MAX_BLOCKS - 1) // 2
+    for i in range(0, len(messages), per_post):
+        batch = messages[i : i + per_post]  # noqa: E203
+        header = f"Hello, *{channel}*! We received {len(messages)} messages over email/SMS."
+        if len(messages) > per_post:
+            header += f" (Part {i // per_post + 1} of {(len(messages) - 1) // per_post + 1}.)"
+        blocks = [dict(type="section", text=dict(type="mrkdwn", text=header))]
+        for message in batch:
+            blocks += [dict(type="divider"), message["blocks"][-1]]
+        send_message_to_channel(channel, "\n".join(message["text"] for message in batch), blocks)
+
+
 def forward_mass_text_reply(human_obj, reply_text):
     channel = human_obj.send_replies_to_channel or settings.DEFAULT_SLACK_CHANNEL
     basic_text = f"Reply received from {human_obj} to mass communications: {reply_text}"
@@ -28,15 +69,10 @@ def forward_mass_text_reply(human_obj, reply_text):
         formatted_phone_number = human_obj.phone_number.as_national
     else:
         formatted_phone_number = "Unknown"
-    blocks = [
-        dict(
-            type="section",
-            text=dict(
-                type="mrkdwn",
-                text=f"Hello, *{channel}*! We received a reply to a recent mass communications over email/SMS.",
-            ),
-        ),
-        dict(type="divider"),
+    forward_message(
+        channel,
+        basic_text,
+        f"Hello, *{channel}*! We received a reply to a recent mass communications over email/SMS.",
         dict(
             type="section",
             text=dict(
@@ -50,25 +86,18 @@ def forward_mass_text_reply(human_obj, reply_text):
                 ),
             ),
         ),
-    ]
-    send_message_to_channel(channel, basic_text, blocks)
+    )
 
 
 def forward_unknown_message(sender_id, message_text):
     channel = settings.DEFAULT_SLACK_CHANNEL
     basic_text = f"Reply received from {sender_id} to mass communications: {message_text}"
-    blocks = [
-        dict(
-            type="section",
-            text=dict(
-                type="mrkdwn",
-                text=f"Hello, *{channel}*! We received a message from an unfamiliar sender over email/SMS.",
-            ),
-        ),
-        dict(type="divider"),
+    forward_message(
+        channel,
+        basic_text,
+        f"Hello, *{channel}*! We received a message from an unfamiliar sender over email/SMS.",
         dict(
             type="section",
             text=dict(type="mrkdwn", text=(f"From: {sender_id}\n\n" f"Message:\n\n" f"```{message_text}```")),
         ),
-    ]
-    send_message_to_channel(channel, basic_text, blocks)
+    )
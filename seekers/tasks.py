@@ -1,17 +1,82 @@
+from collections import defaultdict
+import os
+import smtplib
+from urllib.parse import urlsplit
+
 from celery import shared_task
 from celery.utils.log import get_task_logger
+from celery.utils.time import get_exponential_backoff_interval
 from django.conf import settings
-from django.core.mail import send_mail
+from django.core.mail import EmailMessage, get_connection
+from django.core.mail.message import make_msgid
+from django.core.mail.utils import DNS_NAME
+from django.db.models import F, Max
+from django.utils.timezone import now
+from mailchimp3.mailchimpclient import MailChimpError
+import redis
 import requests
 import requests.exceptions
 
-from .models import Human
+from athene.redis_client import CircuitBreaker
+from .models import Campaign, Human, MailchimpBatch, MailchimpMember, OutboundMessage
 from .constants import EMAIL, SMS
-from . import twilio
+from . import delivery, mailchimp, twilio
 
 
 logger = get_task_logger(__name__)
 
+EMAIL_BATCH_RETRIES = 3
+
+# How many recipients go in each send_messages_bulk task
+BULK_CHUNK_SIZE = 100
+
+# How many people's Mailchimp subscriptions each run of refresh_mailchimp_members looks up
+MAILCHIMP_REFRESH_BATCH = 200
+
+MAILCHIMP_UPDATE_RETRIES = 5
+
+# async_request and apply_mailchimp_update back off exponentially from this many seconds between retries, up
+# to the maximum
+RETRY_BACKOFF = 30
+RETRY_BACKOFF_MAX = 60 * 30
+
+# How many times async_request puts a request off while its host's circuit breaker is open, even for requests
+# that aren't otherwise retried, such as forwarding replies to Slack
+CIRCUIT_OPEN_RETRIES = 5
+
+
+def send_text(human_obj, body, campaign_id=None):
+    """Texts ``body`` to someone, returning an unsaved OutboundMessage recording it."""
+    sid = twilio.sms.send_text(str(human_obj.phone_number), body)
+    return OutboundMessage(
+        human=human_obj,
+        campaign_id=campaign_id,
+        contact_method=SMS,
+        provider_id=sid or "",
+        status=OutboundMessage.FAILED if twilio.sms.live and not sid else OutboundMessage.SENT,
+    )
+
+
+def send_email(human_obj, subject, body, connection=None, campaign_id=None):
+    """Emails someone, returning an unsaved OutboundMessage recording it. The Message-ID is set here so that
+    Mailgun's delivery events can be matched back to it."""
+    message_id = make_msgid(domain=DNS_NAME)
+    EmailMessage(
+        subject,
+        body,
+        settings.DEFAULT_FROM_EMAIL,
+        [human_obj.email],
+        connection=connection,
+        headers={"Message-ID": message_id},
+    ).send()
+    return OutboundMessage(
+        human=human_obj,
+        campaign_id=campaign_id,
+        contact_method=EMAIL,
+        subject=subject,
+        provider_id=message_id.strip("<>"),
+    )
+
 
 @shared_task
 def send_message(human_id, contact_method, message, subject=None):
@@ -20,39 +85,276 @@ def send_message(human_id, contact_method, message, subject=None):
         if not human_obj.email:
             logger.warning(f"Tried sending message to {human_obj} via email but has no email address")
             return
-        send_mail(subject, message, settings.DEFAULT_FROM_EMAIL, [human_obj.email])
+        send_email(human_obj, subject, message).save()
     elif contact_method == SMS:
         if not human_obj.phone_number:
             logger.warning(f"Tried sending message to {human_obj} via SMS but has no phone number")
             return
-        twilio.sms.send_text(str(human_obj.phone_number), message)
+        send_text(human_obj, message).save()
+
+
+@shared_task
+def send_messages_bulk(human_ids, email_subject, email_body, sms_body, contact_method=None, campaign_id=None):
+    """Sends a message to each of ``human_ids`` by ``contact_method``, or by their own contact preference
+    if it's not given. The emails are handed off to send_email_batch together."""
+    emails = []
+    texts = []
+    for human_obj in Human.objects.in_bulk(human_ids).values():
+        method = contact_method or human_obj.contact_preference
+        if method == EMAIL:
+            emails.append((human_obj.pk, email_subject, email_body))
+        elif method == SMS:
+            if not human_obj.phone_number:
+                logger.warning(f"Tried sending message to {human_obj} via SMS but has no phone number")
+                continue
+            texts.append(send_text(human_obj, sms_body, campaign_id))
+        else:
+            logger.warning(f"Tried sending message to {human_obj} but has no contact preference")
+    OutboundMessage.objects.bulk_create(texts)
+    if emails:
+        send_email_batch.delay(emails, campaign_id=campaign_id)
+
+
+@shared_task(bind=True, max_retries=EMAIL_BATCH_RETRIES)
+def send_email_batch(self, items, campaign_id=None):
+    """Emails a batch of (human ID, subject, body) items over a single connection. Items that fail are
+    retried on their own, and returned once there are no retries left."""
+    humans = Human.objects.in_bulk({human_id for human_id, _, _ in items})
+    sent = []
+    failed = []
+    errors = {}
+    connection = get_connection()
+    try:
+        connection.open()
+        for human_id, subject, body in items:
+            human_obj = humans.get(human_id)
+            if human_obj is None or not human_obj.email:
+                logger.warning(f"Tried sending message to {human_obj or human_id} via email but has no email address")
+                continue
+            try:
+                sent.append(send_email(human_obj, subject, body, connection, campaign_id))
+            except (smtplib.SMTPException, OSError) as e:
+                logger.exception(f"Error sending email to {human_obj}")
+                failed.append((human_id, subject, body))
+                errors[human_id] = str(e)
+    except (smtplib.SMTPException, OSError) as e:
+        logger.exception("Could not connect to the mail server")
+        failed = items
+        errors = {human_id: str(e) for human_id, _, _ in items}
+    finally:
+        connection.close()
+    OutboundMessage.objects.bulk_create(sent)
+    if failed and self.request.retries < self.max_retries:
+        logger.warning(f"Queueing {len(failed)} of {len(items)} email(s) for retry.")
+        raise self.retry(args=(failed,), countdown=60 * 2 ** self.request.retries)
+    elif failed:
+        logger.error(f"Could not send {len(failed)} email(s). No more retries. Giving up.")
+        OutboundMessage.objects.bulk_create(
+            OutboundMessage(
+                human_id=human_id,
+                campaign_id=campaign_id,
+                contact_method=EMAIL,
+                subject=subject,
+                status=OutboundMessage.FAILED,
+                error=errors[human_id][:255],
+            )
+            for human_id, subject, _ in failed
+        )
+    return [human_id for human_id, _, _ in failed]
+
+
+@shared_task
+def queue_campaign(campaign_id):
+    """Queues a campaign's messages a chunk of recipients at a time."""
+    campaign_obj = Campaign.objects.get(pk=campaign_id)
+    campaign_obj.status = Campaign.QUEUEING
+    campaign_obj.save(update_fields=["status", "updated"])
+    for page in campaign_obj.recipients(BULK_CHUNK_SIZE):
+        human_ids_by_method = defaultdict(list)
+        for human_id, contact_method in page:
+            human_ids_by_method[contact_method].append(human_id)
+        for contact_method, human_ids in human_ids_by_method.items():
+            send_messages_bulk.delay(
+                human_ids,
+                campaign_obj.email_subject,
+                campaign_obj.email_body,
+                campaign_obj.sms_body,
+                contact_method,
+                campaign_id=campaign_id,
+            )
+        Campaign.objects.filter(pk=campaign_id).update(recipient_count=F("recipient_count") + len(page))
+    Campaign.objects.filter(pk=campaign_id).update(status=Campaign.QUEUED, updated=now())
 
 
 @shared_task
-def async_request(method, *args, retry_count=3, **kwargs):
+def refresh_mailchimp_member(email):
+    mailchimp.client.refresh_member(email)
+
+
+@shared_task(bind=True, max_retries=MAILCHIMP_UPDATE_RETRIES)
+def apply_mailchimp_update(self, email, update=None):
+    """Sends the changes queued for someone's subscription to Mailchimp. If Mailchimp can't be reached or has a
+    server error, the changes are queued again with any made since, and retried with backoff."""
+    if update is None:
+        update = mailchimp.take_update(email)
+    try:
+        if "subscribe" in update:
+            first_names, last_names = update["subscribe"]
+            mailchimp.client.subscribe_user(
+                first_names, last_names, email, update.get("tags", []), fail_silently=False
+            )
+        elif "tags" in update:
+            mailchimp.client.update_user_tags(email, update["tags"], fail_silently=False)
+    except (MailChimpError, requests.RequestException) as e:
+        if isinstance(e, MailChimpError) and mailchimp.error_status(e) < 500:
+            return
+        if self.request.retries >= self.max_retries:
+            logger.error(f"Could not update {email} in Mailchimp. No more retries. Giving up.")
+            return
+        # Put the changes back under any made since, so the retry sends the latest of everything
+        try:
+            if not mailchimp.requeue_update(email, update):
+                # The run already due for the changes made since will send these too
+                return
+            args = (email,)
+        except redis.RedisError:
+            logger.exception(f"Could not reach Redis, retrying the Mailchimp update for {email} as it was")
+            args = (email, update)
+        raise self.retry(
+            args=args,
+            countdown=get_exponential_backoff_interval(
+                RETRY_BACKOFF, self.request.retries, RETRY_BACKOFF_MAX, full_jitter=True
+            ),
+        )
+
+
+@shared_task
+def refresh_mailchimp_members():
+    """Fetches the subscriptions of people we don't have a copy of yet. Those on the list are picked up by
+    sync_mailchimp_list, so this is mostly confirming that people aren't subscribed."""
+    if not mailchimp.client.client:
+        return
+    emails = list(
+        Human.objects.exclude(email="")
+        .filter(mailchimpmember__isnull=True)
+        .values_list("email", flat=True)[:MAILCHIMP_REFRESH_BATCH]
+    )
+    for email in emails:
+        mailchimp.client.refresh_member(email)
+    logger.info(f"Refreshed {len(emails)} Mailchimp subscription(s)")
+
+
+@shared_task
+def sync_mailchimp_list():
+    """Copies the list members that have changed since the last sync, or the whole list the first time."""
+    if not mailchimp.client.client:
+        return
+    since = MailchimpMember.objects.aggregate(since=Max("last_changed"))["since"]
+    created = updated = 0
+    for members in mailchimp.client.iter_members(since_last_changed=since):
+        page_created, page_updated = MailchimpMember.store_list_members(members)
+        created += page_created
+        updated += page_updated
+    logger.info(f"Synced Mailchimp list since {since or 'the beginning'}: {created} new, {updated} updated")
+
+
+@shared_task
+def flush_mailchimp_events(events=None):
+    """Writes the changes Mailchimp has sent to its webhook to our copy of the list."""
+    if events is None:
+        events = mailchimp.take_webhook_events()
+    if not events:
+        return
+    for email in MailchimpMember.apply_webhook_events(events):
+        refresh_mailchimp_member.delay(email)
+    logger.info(f"Applied {len(events)} Mailchimp webhook event(s)")
+
+
+@shared_task
+def poll_mailchimp_batches():
+    """Checks on the tag batches Mailchimp hasn't finished yet, and applies the results of those it has."""
+    for batch_obj in MailchimpBatch.objects.exclude(status=MailchimpBatch.FINISHED):
+        try:
+            status = mailchimp.client.batch_status(batch_obj.batch_id)
+            batch_obj.status = status["status"]
+            if batch_obj.status == MailchimpBatch.FINISHED:
+                failed = batch_obj.apply_results(mailchimp.client.batch_results(status["response_body_url"]))
+                batch_obj.errored_operations = status["errored_operations"]
+                batch_obj.completed = now()
+                for email in failed:
+                    logger.warning(f"Mailchimp could not update the tags for {email}, fetching them again")
+                    refresh_mailchimp_member.delay(email)
+        except (MailChimpError, requests.RequestException):
+            logger.exception(f"Error checking on {batch_obj}")
+            continue
+        batch_obj.save()
+
+
+@shared_task
+def flush_message_statuses():
+    flushed = delivery.flush_statuses()
+    if flushed:
+        logger.info(f"Updated the delivery status of {flushed} message(s)")
+
+
+@shared_task
+def flush_forwarded_messages(channel):
+    from . import slack
+
+    slack.flush_forwarded_messages(channel)
+
+
+_sessions = {}
+
+
+def http_session():
+    """Returns a session for this worker process, so its connections are kept open between requests."""
+    pid = os.getpid()
+    if pid not in _sessions:
+        _sessions.clear()
+        _sessions[pid] = requests.Session()
+    return _sessions[pid]
+
+
+@shared_task(bind=True, max_retries=None)
+def async_request(self, method, *args, retry_count=3, **kwargs):
+    """Makes an HTTP request, retrying up to ``retry_count`` times with exponential backoff if it times out,
+    can't connect or gets a server error. Once a host has failed too often, further requests to it are put off
+    without being tried until it's had time to recover, up to CIRCUIT_OPEN_RETRIES times."""
     if "timeout" not in kwargs:
         kwargs["timeout"] = 3.0
+    description = f"{method.upper()} to {args[0]}"
+    breaker = CircuitBreaker(f"http:{urlsplit(args[0]).netloc}")
+    if breaker.is_open():
+        if not self.request.called_directly and self.request.retries < max(retry_count, CIRCUIT_OPEN_RETRIES):
+            logger.warning(
+                f"Putting off {description}, it has been failing. Trying again in {breaker.cooldown} seconds."
+            )
+            raise self.retry(countdown=breaker.cooldown)
+        logger.error(f"Skipping {description}, it has been failing. Giving up.")
+        return
     try:
-        response = requests.request(method, *args, **kwargs)
+        response = http_session().request(method, *args, **kwargs)
         response.raise_for_status()
-    except requests.exceptions.Timeout:
-        if retry_count:
-            logger.warning(f"Timeout during {method.upper()} to {args[0]}. Queueing for retry.")
-            retry_count -= 1
-            async_request.s(method, *args, retry_count=retry_count, **kwargs).apply_async(countdown=60 * 5)
-        else:
-            logger.error(f"Timeout during {method.upper()} to {args[0]}. No more retries. Giving up.")
+    except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+        breaker.record_failure()
+        error = f"{e.__class__.__name__} during {description}"
     except requests.exceptions.HTTPError:
+        error = f"HTTP error during {description}: ({response.status_code}) {response.text}"
         if response.status_code // 100 == 5:
-            if retry_count:
-                logger.warning(
-                    f"HTTP error during {method.upper()} to {args[0]}: ({response.status_code}) {response.text} - Queueing for retry."
-                )
-                retry_count -= 1
-                async_request.s(method, *args, retry_count=retry_count, **kwargs).apply_async(countdown=60 * 5)
-            else:
-                logger.error(
-                    f"HTTP error during {method.upper()} to {args[0]}: ({response.status_code}) {response.text} - No more retries. Giving up."
-                )
-        else:
-            logger.error(f"HTTP error during {method.upper()} to {args[0]}: ({response.status_code}) {response.text}")
+            breaker.record_failure()
+        elif response.status_code != 429:
+            breaker.record_success()
+            logger.error(error)
+            return
+    else:
+        breaker.record_success()
+        return
+
+    if self.request.retries < retry_count:
+        countdown = get_exponential_backoff_interval(
+            RETRY_BACKOFF, self.request.retries, RETRY_BACKOFF_MAX, full_jitter=True
+        )
+        logger.warning(f"{error} - Queueing for retry in {countdown} seconds.")
+        raise self.retry(countdown=countdown)
+    logger.error(f"{error} - No more retries. Giving up.")
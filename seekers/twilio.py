@@ -1,12 +1,27 @@
 import logging
 import os
+import threading
+import time
 
 from django.conf import settings
 import requests
+import requests.adapters
+
+from athene.redis_client import TokenBucket
 
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_API_BASE = "https://api.twilio.com"
+
+# Seconds to wait to connect to Twilio, and then for its response
+CONNECT_TIMEOUT = 3.05
+READ_TIMEOUT = 10
+
+# How many times a text is attempted when Twilio says we're sending too fast, and the backoff between attempts
+MAX_ATTEMPTS = 4
+BACKOFF = 1.0
+
 
 class SMS(object):
     def __init__(self):
@@ -18,22 +33,62 @@ class SMS(object):
             self.my_phone_number = os.environ.get("TWILIO_PHONE_NUMBER")
         else:
             self.auth = self.my_phone_number = None
+        self.api_base = settings.TWILIO_API_BASE or DEFAULT_API_BASE
+        # Texts are only logged while debugging, unless they're going to a stand-in for Twilio
+        self.dry_run = settings.DEBUG and not settings.TWILIO_API_BASE
+        self.limiter = TokenBucket("twilio", settings.TWILIO_RATE_LIMIT, settings.TWILIO_RATE_BURST)
+        self._local = threading.local()
+
+    @property
+    def live(self):
+        """Whether texts are actually sent, rather than only logged."""
+        return bool(self.auth) and not self.dry_run
+
+    @property
+    def session(self):
+        # Each thread keeps its own connection to Twilio open between texts
+        if not hasattr(self._local, "session"):
+            session = requests.Session()
+            session.auth = self.auth
+            session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=4))
+            self._local.session = session
+        return self._local.session
+
+    def post_message(self, data):
+        """Posts a message to Twilio, waiting for the shared rate limit first, and backing off and trying again
+        when Twilio answers that we're sending too fast."""
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            self.limiter.acquire()
+            response = self.session.post(
+                f"{self.api_base}/2010-04-01/Accounts/{self.username}/Messages.json",
+                data=data,
+                timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+            )
+            if response.status_code != 429 or attempt == MAX_ATTEMPTS:
+                break
+            try:
+                delay = float(response.headers["Retry-After"])
+            except (KeyError, ValueError):
+                delay = BACKOFF * 2 ** (attempt - 1)
+            logger.warning(f"Twilio is rate limiting us, trying again in {delay} seconds")
+            time.sleep(delay)
+        response.raise_for_status()
+        return response
 
     def send_text(self, recipient, content):
+        """Texts ``content`` to ``recipient``, returning Twilio's SID for the message if it was sent."""
         try:
             logger.info(f"Sending SMS to {recipient}")
-            if settings.DEBUG or not self.auth:
+            if not self.live:
                 logger.info(f"{content}")
             else:
-                response = requests.post(
-                    f"https://api.twilio.com/2010-04-01/Accounts/{self.username}/Messages.json",
-                    data={"To": recipient, "From": self.my_phone_number, "Body": content},
-                    auth=self.auth,
-                )
-                response.raise_for_status()
+                data = {"To": recipient, "From": self.my_phone_number, "Body": content}
+                if settings.TWILIO_STATUS_CALLBACK_URL:
+                    data["StatusCallback"] = settings.TWILIO_STATUS_CALLBACK_URL
+                return self.post_message(data).json()["sid"]
         except requests.RequestException as e:
             logger.exception("Error communicating with Twilio!")
-            if e.response.text:
+            if e.response is not None and e.response.text:
                 logger.error(f"Twilio error: {e.response.text}")
 
 
@@ -1,5 +1,6 @@
 import hashlib
 import hmac
+import json
 import logging
 import os
 import re
@@ -11,12 +12,37 @@ import phonenumbers
 from twilio.twiml.messaging_response import MessagingResponse
 from twilio.request_validator import RequestValidator
 
-from .models import Human
-from . import slack
+from .models import Human, OutboundMessage
+from . import delivery, mailchimp, slack
 
 logger = logging.getLogger(__name__)
 MAILGUN_SIGNING_KEY = os.environ.get("MAILGUN_WEBHOOK_SIGNING_KEY")
 TWILIO_AUTH_TOKEN = os.environ.get("TWILIO_AUTH_TOKEN")
+MAILCHIMP_WEBHOOK_KEY = os.environ.get("MAILCHIMP_WEBHOOK_KEY")
+
+
+def mailgun_signature_valid(timestamp, token, signature):
+    if not MAILGUN_SIGNING_KEY:
+        return False
+    hmac_digest = hmac.new(
+        key=MAILGUN_SIGNING_KEY.encode(), msg=f"{timestamp}{token}".encode(), digestmod=hashlib.sha256,
+    ).hexdigest()
+    return hmac.compare_digest(str(signature), str(hmac_digest))
+
+
+def twilio_signature_valid(request):
+    validator = RequestValidator(TWILIO_AUTH_TOKEN)
+
+    # Validate the request using its URL, POST data,
+    # and X-TWILIO-SIGNATURE header
+    request_valid = validator.validate(
+        request.build_absolute_uri(), request.POST, request.META.get("HTTP_X_TWILIO_SIGNATURE", "")
+    )
+    if not request_valid:
+        logger.error(
+            f'Twilio signature failed: {request.build_absolute_uri()} + {request.POST} vs {request.META.get("HTTP_X_TWILIO_SIGNATURE")}'
+        )
+    return request_valid
 
 
 @http.require_POST
@@ -27,12 +53,7 @@ def mailgun_webhook(request):
 
     # Verify signature
     try:
-        hmac_digest = hmac.new(
-            key=MAILGUN_SIGNING_KEY.encode(),
-            msg=f'{request.POST["timestamp"]}{request.POST["token"]}'.encode(),
-            digestmod=hashlib.sha256,
-        ).hexdigest()
-        assert hmac.compare_digest(str(request.POST["signature"]), str(hmac_digest))
+        assert mailgun_signature_valid(request.POST["timestamp"], request.POST["token"], request.POST["signature"])
     except (KeyError, AssertionError):
         if (not settings.MAILGUN_BYPASS_SIGNATURE) or (not settings.DEBUG):
             return HttpResponse(status=400, content="Signature verification failed.")
@@ -61,20 +82,9 @@ def twilio_webhook(request):
     if not TWILIO_AUTH_TOKEN:
         return HttpResponse(status=501, content="Webhook auth token not set.")
 
-    validator = RequestValidator(TWILIO_AUTH_TOKEN)
-
-    # Validate the request using its URL, POST data,
-    # and X-TWILIO-SIGNATURE header
-    request_valid = validator.validate(
-        request.build_absolute_uri(), request.POST, request.META.get("HTTP_X_TWILIO_SIGNATURE", "")
-    )
-
     # Continue processing the request if it's valid, return a 403 error if
     # it's not
-    if not request_valid:
-        logger.error(
-            f'Twilio signature failed: {request.build_absolute_uri()} + {request.POST} vs {request.META.get("HTTP_X_TWILIO_SIGNATURE")}'
-        )
+    if not twilio_signature_valid(request):
         if not (settings.DEBUG or settings.TWILIO_BYPASS_SIGNATURE):
             return HttpResponse(status=403, content="Signature verification failed")
 
@@ -96,3 +106,102 @@ def twilio_webhook(request):
 
     # Return the TwiML
     return HttpResponse(resp)
+
+
+# Twilio's message statuses, as we record them
+TWILIO_STATUSES = {
+    "queued": OutboundMessage.SENT,
+    "sending": OutboundMessage.SENT,
+    "sent": OutboundMessage.SENT,
+    "delivered": OutboundMessage.DELIVERED,
+    "undelivered": OutboundMessage.UNDELIVERED,
+    "failed": OutboundMessage.FAILED,
+}
+
+
+@http.require_POST
+@csrf.csrf_exempt
+def twilio_status_webhook(request):
+    if not TWILIO_AUTH_TOKEN:
+        return HttpResponse(status=501, content="Webhook auth token not set.")
+    if not twilio_signature_valid(request):
+        if not (settings.DEBUG or settings.TWILIO_BYPASS_SIGNATURE):
+            return HttpResponse(status=403, content="Signature verification failed")
+
+    try:
+        status = TWILIO_STATUSES[request.POST["MessageStatus"]]
+        sid = request.POST["MessageSid"]
+    except KeyError:
+        return HttpResponse(status=200, content="Status ignored.")
+    error = request.POST.get("ErrorCode", "")
+    delivery.record_status(sid, status, f"Twilio error {error}" if error else "")
+    return HttpResponse(status=200, content="Status accepted.")
+
+
+@http.require_POST
+@csrf.csrf_exempt
+def mailgun_events_webhook(request):
+    if not (MAILGUN_SIGNING_KEY or settings.MAILGUN_BYPASS_SIGNATURE):
+        return HttpResponse(status=501, content="Webhook signing key not set.")
+
+    try:
+        payload = json.loads(request.body)
+        assert isinstance(payload, dict)
+    except (ValueError, AssertionError):
+        return HttpResponse(status=400, content="Invalid event payload.")
+
+    try:
+        signature = payload["signature"]
+        assert mailgun_signature_valid(signature["timestamp"], signature["token"], signature["signature"])
+    except (KeyError, TypeError, AssertionError):
+        if (not settings.MAILGUN_BYPASS_SIGNATURE) or (not settings.DEBUG):
+            return HttpResponse(status=400, content="Signature verification failed.")
+
+    event_data = payload.get("event-data", {})
+    event = event_data.get("event")
+    if event == "delivered":
+        status = OutboundMessage.DELIVERED
+    elif event == "rejected" or (event == "failed" and event_data.get("severity") == "permanent"):
+        status = OutboundMessage.FAILED
+    else:
+        # Temporary failures are retried by Mailgun, and opens, clicks and the like don't change delivery
+        return HttpResponse(status=200, content="Event ignored.")
+    message_id = event_data.get("message", {}).get("headers", {}).get("message-id")
+    if not message_id:
+        return HttpResponse(status=200, content="Event ignored.")
+    delivery_status = event_data.get("delivery-status", {})
+    error = delivery_status.get("description") or delivery_status.get("message") or event_data.get("reason", "")
+    delivery.record_status(message_id, status, error if status == OutboundMessage.FAILED else "")
+    return HttpResponse(status=200, content="Event accepted.")
+
+
+@http.require_http_methods(["GET", "POST"])
+@csrf.csrf_exempt
+def mailchimp_webhook(request):
+    if not MAILCHIMP_WEBHOOK_KEY:
+        return HttpResponse(status=501, content="Webhook key not set.")
+
+    # Mailchimp doesn't sign its webhooks, so the URL we give it carries a key instead
+    if not hmac.compare_digest(request.GET.get("key", ""), MAILCHIMP_WEBHOOK_KEY):
+        return HttpResponse(status=403, content="Key verification failed.")
+
+    # Mailchimp checks that the URL works with a GET when the webhook is set up
+    if request.method == "GET":
+        return HttpResponse(status=200, content="Webhook ready.")
+
+    event_type = request.POST.get("type")
+    email = request.POST.get("data[old_email]" if event_type == "upemail" else "data[email]")
+    if event_type not in ("subscribe", "unsubscribe", "profile", "upemail", "cleaned") or not email:
+        return HttpResponse(status=200, content="Event ignored.")
+    if settings.MAILCHIMP_LIST_ID and request.POST.get("data[list_id]") != settings.MAILCHIMP_LIST_ID:
+        return HttpResponse(status=200, content="Event ignored.")
+    mailchimp.record_webhook_event(
+        dict(
+            type=event_type,
+            email=email,
+            new_email=request.POST.get("data[new_email]", ""),
+            action=request.POST.get("data[action]", ""),
+            reason=request.POST.get("data[reason]", "")[:255],
+        )
+    )
+    return HttpResponse(status=200, content="Event accepted.")